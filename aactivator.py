@@ -23,59 +23,505 @@ remember your answer. You can later adjust your per-project preferences in the
 
 see also: https://github.com/Yelp/aactivator
 """
-from __future__ import absolute_import
-from __future__ import print_function
-from __future__ import unicode_literals
-
-import io
+import errno
 import os.path
-import stat
 import sys
 from os.path import relpath
-from shlex import quote
 
 
 ENVIRONMENT_VARIABLE = 'AACTIVATOR_ACTIVE'
+# What activating changed, where there's no .deactivate.sh to undo it
+RESTORE_VARIABLE = 'AACTIVATOR_RESTORE'
+# Activations whose changes are still to be worked out for RESTORE_VARIABLE
+PENDING_VARIABLE = 'AACTIVATOR_PENDING'
+# Every active project, outermost first, with $AACTIVATOR_NESTED
+STACK_VARIABLE = 'AACTIVATOR_STACK'
+# The hook's shell's pid, passed along to each run (and not exported)
+SHELL_PID_VARIABLE = 'AACTIVATOR_SHELL_PID'
 ACTIVATE = '.activate.sh'
 DEACTIVATE = '.deactivate.sh'
+# What the shell hook compares to decide whether its last answer still holds
+MEMO_KEY = '"$PWD:$AACTIVATOR_VERSION:$%s"' % ENVIRONMENT_VARIABLE
+# `aactivator serve` listens here, under $XDG_RUNTIME_DIR
+SOCKET = 'aactivator.sock'
+# The part of the shell's environment sent along to `aactivator serve`
+SERVED_ENVIRONMENT = (
+    'HOME', 'XDG_CACHE_HOME', 'AACTIVATOR_VERSION', ENVIRONMENT_VARIABLE, 'AACTIVATOR_INDEX',
+    'AACTIVATOR_NEGATIVE_CACHE', 'AACTIVATOR_TIMEOUT_MS', 'AACTIVATOR_SKIP_FSTYPES', 'AACTIVATOR_PROFILE',
+    'AACTIVATOR_GC_SIZE', 'AACTIVATOR_ENV_CACHE', RESTORE_VARIABLE, PENDING_VARIABLE, 'AACTIVATOR_NESTED',
+    STACK_VARIABLE, 'AACTIVATOR_PREFETCH',
+)
+# How many stat calls $AACTIVATOR_PREFETCH has in flight at once
+PREFETCH_WORKERS = 8
+MOUNTINFO = '/proc/self/mountinfo'
+# `--name=value` options accepted by `aactivator init`, default first
+INIT_OPTIONS = {
+    'mode': ('default', 'fast'),
+    'trigger': ('prompt', 'chpwd'),
+}
 
 __version__ = '2.0.0'
 
 
-def init(arg0):
+def parse_options(args):
+    """`--name=value` arguments as a dict of INIT_OPTIONS, or None if invalid"""
+    options = {}
+    for arg in args:
+        name, sep, value = arg.partition('=')
+        name = name[2:] if name.startswith('--') else None
+        if not sep or value not in INIT_OPTIONS.get(name, ()):
+            return None
+        options[name] = value
+    return options
+
+
+def format_options(options):
+    return ''.join(
+        ' --{0}={1}'.format(name, value)
+        for name, value in sorted(options.items())
+        if value != INIT_OPTIONS[name][0]
+    )
+
+
+def launch_command(arg0):
+    """How the hook runs us: this module, imported straight from the
+    interpreter.
+
+    Isolated and without `site`, so that nothing from the environment's
+    site-packages (.pth files, sitecustomize, entry point metadata) is read on
+    every prompt; only the standard library is needed.  Importing rather than
+    running the file means the byte-compiled copy in __pycache__ is used
+    instead of compiling the source on each prompt.  arg0 goes along to stand
+    in for sys.argv[0].
+    """
+    module = os.path.realpath(__file__)
+    if not sys.executable or os.path.basename(module) != 'aactivator.py':
+        return quote(arg0)
+    code = 'import sys; sys.path.append({0!r}); from aactivator import main; sys.exit(main())'.format(
+        os.path.dirname(module),
+    )
+    return '{0} -I -S -c {1} --arg0={2}'.format(quote(sys.executable), quote(code), quote(arg0))
+
+
+# What the hook runs: evaluating aactivator's answer in the caller's scope
+_APPLY = '_aactivator_prepare && { eval "$_aactivator_reply"; _aactivator_done $?; }'
+
+
+def init(arg0, mode='default', trigger='prompt'):
     arg0 = os.path.realpath(arg0)
-    cmd = 'if [ -x {exe} ]; then  eval "`{exe}`"; fi'.format(exe=arg0)
+    # The hook passes our options back to us, so that re-running init keeps them
+    options = format_options({'mode': mode, 'trigger': trigger})
+    if mode == 'fast':
+        skip = ' && ! _aactivator_fast'
+    else:
+        skip = ''
+    if trigger == 'chpwd':
+        # Between changes of $PWD (or of our variables), only look every so often
+        hook = '''\
+    if [ "$_aactivator_seen" != {memo_key} ] ||
+        [ $((SECONDS - _aactivator_when)) -ge "${{AACTIVATOR_INTERVAL:-60}}" ]; then
+        _aactivator_seen={memo_key}
+        _aactivator_when=$SECONDS
+        _aactivator_update
+    fi'''.format(memo_key=MEMO_KEY)
+        chpwd = '''\
+    if ! [ "${chpwd_functions[(r)precmd_aactivator]}" ]; then
+        chpwd_functions=(precmd_aactivator $chpwd_functions)
+    fi
+'''
+    else:
+        hook = '    _aactivator_update'
+        chpwd = ''
     return '''\
 export AACTIVATOR_VERSION={version}
 alias aactivator={arg0}
-unset {varname}
+unset {varname} _aactivator_memo _aactivator_snapshot _aactivator_seen _aactivator_busy _aactivator_reply
+_aactivator_fresh() {{
+    [ "$_aactivator_memo" = {memo_key} ] && [ -f "$_aactivator_stamp" ] || return 1
+    local watched
+    for watched in "${{_aactivator_watch[@]}}"; do
+        if [ "$watched" -nt "$_aactivator_stamp" ]; then return 1; fi
+    done
+}}
+_aactivator_fast() {{
+    # Only the innermost project is looked for here, not every level of a nested stack
+    [ -z "$AACTIVATOR_NESTED" ] && [ "$AACTIVATOR_VERSION" = {version} ] && [ -f "$_aactivator_snapshot" ] || return 1
+    ! _aactivator_snapshot_stale && _aactivator_not_now_holds || return 1
+    local dir="$PWD" found=
+    while :; do
+        if [ -O "${{dir:-/}}/{activate}" ]; then
+            if _aactivator_allowed "${{dir:-/}}"; then
+                found="${{dir:-/}}"
+                break
+            elif ! _aactivator_declined "${{dir:-/}}"; then
+                return 1
+            fi
+        fi
+        [ "$dir" ] || break
+        dir="${{dir%/*}}"
+    done
+    [ "$found" = "${varname}" ]
+}}
+_aactivator_run() {{
+    local sock="$XDG_RUNTIME_DIR/{socket}" reply
+    if [ "$XDG_RUNTIME_DIR" ] && [ -S "$sock" ] && command -v socat >/dev/null &&
+        reply="$(printf '%s\\0' "$PWD" {arg0}{options} {served} "{pid}=$$" | socat -t 10 - UNIX-CONNECT:"$sock" 2>/dev/null)" &&
+        [ "$reply" ]; then
+        _aactivator_reply="$reply"
+    else
+        _aactivator_reply="`{pid}=$$ {launch}{options}`"
+    fi
+}}
+_aactivator_update() {{
+    if [ -x {arg0} ] && ! _aactivator_fresh{skip}; then
+        unset _aactivator_memo
+        _aactivator_run
+    fi
+}}
+# Sets $_aactivator_reply for the hook to eval; which it does outside of any
+# function where it can, so that `declare` in .activate.sh isn't made local
+_aactivator_prepare() {{
+    unset _aactivator_reply
+{hook}
+    [ "${{_aactivator_reply+set}}" ]
+}}
+_aactivator_done() {{
+    [ "$1" = 0 ] && [ "$_aactivator_memo" ] && : >| "$_aactivator_stamp"
+    unset _aactivator_reply
+}}
+_aactivator_enter() {{
+    _aactivator_pwd="$PWD" _aactivator_oldpwd="$OLDPWD"
+    builtin cd -- "$1"
+}}
+_aactivator_leave() {{
+    local _aactivator_status=$?
+    builtin cd -- "$_aactivator_pwd"
+    OLDPWD="$_aactivator_oldpwd"
+    unset _aactivator_pwd _aactivator_oldpwd
+    return $_aactivator_status
+}}
+precmd_aactivator() {{
+    # zsh runs its chpwd hooks from the cds in the reply; they're not to start
+    # over.  Local, so that an interrupted reply doesn't leave it set
+    [ -z "$_aactivator_busy" ] || return 0
+    local _aactivator_busy=1
+    {apply}
+}}
 if [ "$ZSH_VERSION" ]; then
-    precmd_aactivator() {{ {cmd}; }}
     if ! [ "${{precmd_functions[(r)precmd_aactivator]}}" ]; then
         precmd_functions=(precmd_aactivator $precmd_functions)
     fi
-else
-    if ! ( echo "$PROMPT_COMMAND" | grep -Fq '{cmd}' ); then
-        PROMPT_COMMAND='{cmd}; '"$PROMPT_COMMAND"
-    fi
-fi'''.format(version=__version__, arg0=arg0, cmd=cmd, varname=ENVIRONMENT_VARIABLE)
+{chpwd}else
+    case "$PROMPT_COMMAND" in
+        *_aactivator_prepare*|*precmd_aactivator*) ;;
+        *) PROMPT_COMMAND={apply_quoted}"$PROMPT_COMMAND" ;;
+    esac
+fi'''.format(
+        version=__version__,
+        arg0=arg0,
+        launch=launch_command(arg0),
+        apply=_APPLY,
+        apply_quoted=quote(_APPLY + '; '),
+        options=options,
+        skip=skip,
+        hook=hook,
+        chpwd=chpwd,
+        activate=ACTIVATE,
+        memo_key=MEMO_KEY,
+        varname=ENVIRONMENT_VARIABLE,
+        socket=SOCKET,
+        pid=SHELL_PID_VARIABLE,
+        served=' '.join('"{0}=${0}"'.format(name) for name in SERVED_ENVIRONMENT),
+    )
+
+
+class SlowFilesystem(Exception):
+    """Looking at path took longer than $AACTIVATOR_TIMEOUT_MS allows"""
+
+    def __init__(self, path):
+        super(SlowFilesystem, self).__init__(path)
+        self.path = path
+
+
+class StatCache(object):
+    """stat/lstat results for the life of one invocation.
+
+    One prompt looks at the same paths many times over (resolving $PWD, the
+    parent walk, ownership and security checks); this makes each of those a
+    single system call, and counts the calls actually made in `calls`.
+
+    With a `timeout` (in seconds), the calls are made by a worker thread, and
+    any call still unanswered that long after the cache was created raises
+    SlowFilesystem instead; the worker is abandoned to it.
+    """
+
+    def __init__(self, timeout=None):
+        self.calls = 0
+        self._stat = {}
+        self._lstat = {}
+        self._readlink = {}
+        if timeout is None:
+            self.deadline = None
+        else:
+            import time
+            self.deadline = time.monotonic() + timeout
+        self.timed_out = None
+        self._worker = None
+        self._mounts = False
+
+    def _call(self, cache, func, path):
+        try:
+            result = cache[path]
+        except KeyError:
+            self.calls += 1
+            try:
+                if self.deadline is None:
+                    result = func(path)
+                else:
+                    result = self._bounded(func, path)
+            except OSError as error:
+                result = error
+            cache[path] = result
+        if isinstance(result, OSError):
+            raise result
+        return result
+
+    def _bounded(self, func, path):
+        """func(path) from the worker thread, unless the deadline passes first"""
+        import queue
+        import threading
+        import time
+        if self._worker is None:
+            self._requests, self._results = queue.SimpleQueue(), queue.SimpleQueue()
+            self._worker = threading.Thread(target=self._work, args=(self._requests, self._results), daemon=True)
+            self._worker.start()
+        self._requests.put((func, path))
+        try:
+            raised, result = self._results.get(timeout=max(0, self.deadline - time.monotonic()))
+        except queue.Empty:
+            # Whatever it eventually answers goes to queues nobody reads anymore
+            self._worker = None
+            self.timed_out = path
+            raise SlowFilesystem(path)
+        if raised:
+            raise result
+        return result
+
+    def untimed(self, func):
+        """func(), with the deadline put back by however long it took"""
+        if self.deadline is None:
+            return func()
+        import time
+        start = time.monotonic()
+        try:
+            return func()
+        finally:
+            self.deadline += time.monotonic() - start
+
+    def answered(self, path):
+        """Whether stat or lstat of path has already come back, one way or another"""
+        return path in self._stat or path in self._lstat
+
+    def prefetch(self, paths, workers=PREFETCH_WORKERS, lstat=()):
+        """stat all of paths (and lstat those in lstat) at once from a few
+        threads, rather than one after another.
+
+        Afterwards stat() and lstat() answer from what was gathered.  Where the
+        deadline passes first, the stragglers are left to be stat'ed (and to
+        time out) the usual way.
+        """
+        import queue
+        import stat
+        import threading
+        import time
+        jobs = [(os.stat, path) for path in dict.fromkeys(paths) if path not in self._stat]
+        jobs += [(os.lstat, path) for path in dict.fromkeys(lstat) if path not in self._lstat]
+        if not jobs:
+            return
+        requests, results = queue.SimpleQueue(), queue.SimpleQueue()
+        for job in jobs:
+            requests.put(job)
+        for _ in range(min(workers, len(jobs))):
+            threading.Thread(target=self._prefetch_work, args=(requests, results), daemon=True).start()
+        for _ in jobs:
+            try:
+                if self.deadline is None:
+                    func, path, result = results.get()
+                else:
+                    func, path, result = results.get(timeout=max(0, self.deadline - time.monotonic()))
+            except queue.Empty:
+                return
+            self.calls += 1
+            if func is os.stat:
+                self._stat.setdefault(path, result)
+            else:
+                self._lstat.setdefault(path, result)
+                if isinstance(result, os.stat_result) and not stat.S_ISLNK(result.st_mode):
+                    self._stat.setdefault(path, result)  # stat would say the same
 
+    @staticmethod
+    def _prefetch_work(requests, results):
+        import queue
+        while True:
+            try:
+                func, path = requests.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = func(path)
+            except OSError as error:
+                result = error
+            results.put((func, path, result))
 
-def get_filesystem_id(path):
+    @staticmethod
+    def _work(requests, results):
+        while True:
+            func, path = requests.get()
+            try:
+                results.put((False, func(path)))
+            except Exception as error:
+                results.put((True, error))
+
+    def stat(self, path):
+        """os.stat(path), or None if there is nothing there"""
+        try:
+            return self._call(self._stat, os.stat, path)
+        except OSError as error:
+            if error.errno in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            else:
+                raise
+
+    def lstat(self, path):
+        """os.lstat(path), or None if there is nothing there"""
+        import stat
+        try:
+            result = self._call(self._lstat, os.lstat, path)
+        except OSError as error:
+            if error.errno in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            else:
+                raise
+        if not stat.S_ISLNK(result.st_mode):
+            self._stat.setdefault(path, result)  # stat would say the same
+        return result
+
+    def mounts(self):
+        """read_mounts(), once"""
+        if self._mounts is False:
+            self._mounts = read_mounts()
+        return self._mounts
+
+    def realpath(self, path):
+        """os.path.realpath, looking up each component through the cache"""
+        path, _ = self._join_realpath('', os.path.abspath(path), {})
+        return os.path.abspath(path)
+
+    def _join_realpath(self, path, rest, seen):
+        # stolen from posixpath._joinrealpath (non-strict)
+        import stat
+        if os.path.isabs(rest):
+            rest = rest[1:]
+            path = '/'
+        while rest:
+            name, _, rest = rest.partition('/')
+            if not name or name == '.':
+                continue
+            if name == '..':
+                if path:
+                    path, name = os.path.split(path)
+                    if name == '..':
+                        path = os.path.join(path, '..', '..')
+                else:
+                    path = '..'
+                continue
+            newpath = os.path.join(path, name)
+            try:
+                st = self.lstat(newpath)
+            except OSError:
+                st = None
+            if st is None or not stat.S_ISLNK(st.st_mode):
+                path = newpath
+                continue
+            if newpath in seen:
+                path = seen[newpath]
+                if path is not None:
+                    continue
+                # The symlink is not resolved, so we must have a symlink loop.
+                return os.path.join(newpath, rest), False
+            seen[newpath] = None
+            path, ok = self._join_realpath(path, self._call(self._readlink, os.readlink, newpath), seen)
+            if not ok:
+                return os.path.join(path, rest), False
+            seen[newpath] = path
+        return path, True
+
+
+def _unescape_mountinfo(field):
+    """mountinfo writes space, tab, newline and backslash as octal escapes"""
+    if '\\' not in field:
+        return field
+    head, *escaped = field.split('\\')
+    return head + ''.join(chr(int(part[:3], 8)) + part[3:] for part in escaped)
+
+
+def parse_mountinfo(data):
+    """{mount point: (st_dev, fstype)} for the mounts visible in mountinfo data"""
+    mounts = {}
+    for line in os.fsdecode(data).splitlines():
+        fields = line.split(' ')
+        try:
+            separator = fields.index('-', 6)
+            major, minor = fields[2].split(':')
+            # A later mount on the same point hides the earlier ones
+            mounts[_unescape_mountinfo(fields[4])] = (
+                os.makedev(int(major), int(minor)), fields[separator + 1],
+            )
+        except (ValueError, IndexError):  # not what we expected, ignore it
+            continue
+    return mounts
+
+
+# The last mountinfo read, and what it parsed to; it rarely changes, and `serve` reads it a lot
+_mountinfo_parsed = {}
+
+
+def read_mounts(path=MOUNTINFO):
+    """parse_mountinfo(path), or None where there's no such thing"""
     try:
-        return os.stat(path).st_dev
-    except OSError as error:
-        if error.errno == 2:  # no such file
+        with open(path, 'rb') as mountinfo:
+            data = mountinfo.read()
+    except OSError:
+        return None
+    _reads[0] += 1
+    _reads[1] += len(data)
+    if data not in _mountinfo_parsed:
+        _mountinfo_parsed.clear()
+        _mountinfo_parsed[data] = parse_mountinfo(data)
+    return _mountinfo_parsed[data]
+
+
+def find_mount(mounts, path):
+    """The mount point path (which is absolute and normalized) is on"""
+    while path not in mounts:
+        parent = os.path.dirname(path)
+        if parent == path:
             return None
-        else:
-            raise
+        path = parent
+    return path
 
 
-def insecure_inode(path):
+def get_filesystem_id(path, stats=None):
+    st = (stats or StatCache()).stat(path)
+    return None if st is None else st.st_dev
+
+
+def insecure_inode(path, stats=None):
     """This particular inode can be altered by someone other than the owner"""
-    pathstat = os.stat(path).st_mode
+    import stat
+    pathstat = (stats or StatCache()).stat(path).st_mode
     # Directories with a sticky bit are always acceptable.
-    if os.path.isdir(path) and pathstat & stat.S_ISVTX:
+    if stat.S_ISDIR(pathstat) and pathstat & stat.S_ISVTX:
         return False
     # The path is writable by someone who is not us.
     elif pathstat & (stat.S_IWGRP | stat.S_IWOTH):
@@ -90,20 +536,82 @@ def first(iterable, predicate):
             return x
 
 
-def insecure(path):
+def insecure(path, stats=None):
     """Find an insecure path, at or above this one"""
-    return first(search_parent_paths(path), insecure_inode)
+    stats = stats or StatCache()
+    return first(search_parent_paths(path, stats), lambda path: insecure_inode(path, stats))
 
 
-def search_parent_paths(path):
+def search_parent_paths(path, stats=None, skip_fstypes=()):
+    """path, then its parents as long as they're on the same filesystem.
+
+    Where the mount table is available, the boundary comes from there rather
+    than from a stat of each parent, and nothing is searched on filesystems
+    of the types in skip_fstypes (`fuse` standing for every `fuse.*` type).
+    """
+    stats = stats or StatCache()
     path = os.path.abspath(path)
-    original_fs_id = fs_id = get_filesystem_id(path)
+    mounts = stats.mounts()
+    mount_point = mounts and find_mount(mounts, path)
+    if mount_point is not None:
+        dev, fstype = mounts[mount_point]
+        if fstype in skip_fstypes or fstype.partition('.')[0] in skip_fstypes:
+            return
+        # If not, path is on something the table doesn't show (a btrfs subvolume, say)
+        if get_filesystem_id(path, stats) == dev:
+            yield from _search_mounted_parent_paths(path, mounts, mount_point, dev)
+            return
+    original_fs_id = fs_id = get_filesystem_id(path, stats)
     previous_path = None
     while original_fs_id == fs_id and path != previous_path:
         yield path
         previous_path = path
         path = os.path.dirname(path)
-        fs_id = get_filesystem_id(path)
+        fs_id = get_filesystem_id(path, stats)
+
+
+def _search_mounted_parent_paths(path, mounts, mount_point, dev):
+    while True:
+        yield path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return
+        if path == mount_point:
+            # Carry on into the mount below only if it's the same filesystem (a bind mount)
+            mount_point = find_mount(mounts, parent)
+            if mount_point is None or mounts[mount_point][0] != dev:
+                return
+        path = parent
+
+
+def prefetch_ancestors(path, stats):
+    """For $AACTIVATOR_PREFETCH: lstat each of path's ancestors, and stat its
+    .activate.sh, all at once.
+
+    Resolving path looks at its components one after another; unless one of
+    them is a symlink, that and the search of its parents then need nothing
+    more from the filesystem.
+    """
+    parents = [path]
+    while os.path.dirname(parents[-1]) != parents[-1]:
+        parents.append(os.path.dirname(parents[-1]))
+    stats.prefetch((os.path.join(parent, ACTIVATE) for parent in parents), lstat=parents)
+
+
+# What shlex.quote leaves alone; shlex itself would cost us `re` on every prompt
+_SAFE_CHARACTERS = frozenset(
+    'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_@%+=:,./-'
+)
+
+
+def quote(s):
+    """Same as shlex.quote"""
+    if not s:
+        return "''"
+    elif _SAFE_CHARACTERS.issuperset(s):
+        return s
+    else:
+        return "'" + s.replace("'", "'\"'\"'") + "'"
 
 
 def error_command(message):
@@ -120,26 +628,539 @@ def mkdirp(path):
             raise
 
 
+# How many files this process has read, and how many bytes, for AACTIVATOR_PROFILE
+_reads = [0, 0]
+
+
 def _get_lines_if_there(path):
-    if os.path.exists(path):
-        return io.open(path).read().splitlines()
-    else:
+    try:
+        with open(path) as file_obj:
+            lines = file_obj.read().splitlines()
+            _reads[0] += 1
+            _reads[1] += file_obj.tell()
+            return lines
+    except FileNotFoundError:
         return []
 
 
+def atomic_write(path, data):
+    """Replace path with data, so a crash or reader never sees half a file"""
+    mkdirp(os.path.dirname(path))
+    tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp, 'wb') as file_obj:
+            file_obj.write(data)
+            file_obj.flush()
+            os.fsync(file_obj.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class ConfigLock(object):
+    """An fcntl lock on the `lock` file of a config directory, for writing there.
+
+    Every shell reads and writes the same files: appends hold the lock shared,
+    being single O_APPEND writes which can't tear each other, while anything
+    rewriting a file holds it exclusively, so that no append is lost between
+    reading the file and replacing it.  Readers never wait, as files are only
+    ever replaced by a rename.
+    """
+
+    def __init__(self, directory, exclusive=True):
+        self.path = os.path.join(directory, 'lock')
+        self.exclusive = exclusive
+        self.fd = None
+
+    def __enter__(self):
+        import fcntl
+        mkdirp(os.path.dirname(self.path))
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+        except BaseException:
+            os.close(self.fd)
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        os.close(self.fd)  # which releases the lock
+
+
+def _encode(line):
+    return line.encode('UTF-8', 'surrogateescape')
+
+
 class ConfigFile(object):
 
     def __init__(self, directory, name):
         self.path = os.path.join(directory, name)
         self.lines = frozenset(_get_lines_if_there(self.path))
 
-    def write(self, mode, value):
-        mkdirp(os.path.dirname(self.path))
-        with io.open(self.path, mode) as file_obj:
-            file_obj.write(value)
+    def __contains__(self, line):
+        return line in self.lines
+
+    def lock(self, exclusive=True):
+        return ConfigLock(os.path.dirname(self.path), exclusive)
+
+    def _append(self, value):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        try:
+            os.write(fd, _encode(value + '\n'))
+        finally:
+            os.close(fd)
+
+    def append(self, value):
+        with self.lock(exclusive=False):
+            self._append(value)
+
+    def _replace(self, lines):
+        atomic_write(self.path, ''.join(line + '\n' for line in lines).encode('UTF-8', 'surrogateescape'))
+        self.lines = frozenset(lines)
+
+    def update(self, change):
+        """Rewrite the file as change(the set of its lines, as they are on disk right now)"""
+        with self.lock():
+            lines = _get_lines_if_there(self.path)
+            changed = list(change(frozenset(lines)))
+            if changed != lines:
+                self._replace(changed)
+            else:
+                self.lines = frozenset(lines)
+        return len(lines), len(changed)
+
+
+# Native-endian, it never leaves this machine: magic, then the text file's
+# (st_ino, st_size, st_mtime_ns) when indexed, then the number of entries
+_INDEX_HEADER = '=8sQQQQ'
+_INDEX_MAGIC = b'aactidx1'
+
+
+class IndexedConfigFile(ConfigFile):
+    """A ConfigFile answering `in` from a sorted, memory-mapped index.
+
+    The index (`<name>.idx`) is a table of offsets followed by the
+    length-prefixed entries in sorted order, so a lookup is a binary search
+    which never parses the text file.  The text file stays the source of
+    truth: the index is rebuilt from it whenever it was changed by someone
+    else, and updated in place of a full rebuild by our own `append`.
+    """
+
+    def __init__(self, directory, name):
+        self.path = os.path.join(directory, name)
+        self.index_path = self.path + '.idx'
+        self._lines = None
+        self._index = None
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            self._lines = frozenset(_get_lines_if_there(self.path))
+        return self._lines
+
+    @lines.setter
+    def lines(self, lines):
+        self._lines = lines
+
+    def _signature(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _load_index(self, signature):
+        """The mmap'ed index if it was built from the text file with this signature"""
+        import mmap
+        import struct
+        try:
+            with open(self.index_path, 'rb') as file_obj:
+                index = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # missing, or empty
+            return None
+        if (
+                len(index) < struct.calcsize(_INDEX_HEADER) or
+                struct.unpack_from(_INDEX_HEADER, index)[:4] != (_INDEX_MAGIC,) + signature
+        ):
+            index.close()
+            return None
+        return index
+
+    def _write_index(self, entries, signature):
+        """Write sorted, encoded entries as the index of the text file with this signature"""
+        import struct
+        offset = struct.calcsize(_INDEX_HEADER) + 8 * len(entries)
+        offsets = []
+        for entry in entries:
+            offsets.append(offset)
+            offset += 4 + len(entry)
+        atomic_write(self.index_path, b''.join(
+            [
+                struct.pack(_INDEX_HEADER, _INDEX_MAGIC, *(signature + (len(entries),))),
+                struct.pack('=%dQ' % len(entries), *offsets),
+            ] + [struct.pack('=I', len(entry)) + entry for entry in entries]
+        ))
+
+    def _rebuild_index(self, signature):
+        self._lines = None
+        self._write_index(sorted(_encode(line) for line in self.lines), signature)
+
+    @property
+    def index(self):
+        if self._index is None:
+            signature = self._signature()
+            if signature is None:
+                return None
+            index = self._load_index(signature)
+            if index is None:
+                self._rebuild_index(signature)
+                index = self._load_index(signature)
+            self._index = index
+        return self._index
+
+    @staticmethod
+    def _count(index):
+        import struct
+        return struct.unpack_from(_INDEX_HEADER, index)[4]
+
+    @staticmethod
+    def _offset(index, position):
+        import struct
+        return struct.unpack_from('=Q', index, struct.calcsize(_INDEX_HEADER) + 8 * position)[0]
+
+    @staticmethod
+    def _entry(index, offset):
+        import struct
+        length, = struct.unpack_from('=I', index, offset)
+        return index[offset + 4:offset + 4 + length]
+
+    def _bisect(self, index, entry):
+        """Where entry is, or would be inserted, among the index's entries"""
+        low, high = 0, self._count(index)
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(index, self._offset(index, middle)) < entry:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __contains__(self, line):
+        try:
+            index = self.index
+        except OSError:  # can't write an index here, make do without
+            return line in self.lines
+        if index is None:
+            return False
+        entry = _encode(line)
+        position = self._bisect(index, entry)
+        return (
+            position < self._count(index) and
+            self._entry(index, self._offset(index, position)) == entry
+        )
+
+    def _spliced(self, index, entry, signature):
+        """The index's contents with entry added, for the text file with this signature"""
+        import struct
+        header = struct.calcsize(_INDEX_HEADER)
+        count = self._count(index)
+        offsets = list(struct.unpack_from('=%dQ' % count, index, header))
+        position = self._bisect(index, entry)
+        at = offsets[position] if position < count else len(index)
+        if position < count and self._entry(index, at) == entry:
+            return struct.pack(_INDEX_HEADER, _INDEX_MAGIC, *(signature + (count,))) + index[header:]
+
+        record = struct.pack('=I', len(entry)) + entry
+        offsets.insert(position, at)
+        offsets = [
+            offset + 8 + (len(record) if i > position else 0)
+            for i, offset in enumerate(offsets)
+        ]
+        return b''.join((
+            struct.pack(_INDEX_HEADER, _INDEX_MAGIC, *(signature + (count + 1,))),
+            struct.pack('=%dQ' % (count + 1), *offsets),
+            index[header + 8 * count:at],
+            record,
+            index[at:],
+        ))
 
     def append(self, value):
-        self.write('a', value + '\n')
+        # Exclusively, as the index gets rewritten too
+        with self.lock():
+            before = self._signature()
+            index = self._load_index(before) if before is not None else None
+            self._append(value)
+            self._lines = self._index = None
+            signature = self._signature()
+            if index is None:
+                self._rebuild_index(signature)
+            elif signature[:2] != (before[0], before[1] + len(_encode(value + '\n'))):
+                # Someone else wrote to it as well, start over from the text
+                index.close()
+                self._rebuild_index(signature)
+            else:
+                # Splice the new entry in, rather than reparsing the text file
+                with index:
+                    data = self._spliced(index, _encode(value), signature)
+                atomic_write(self.index_path, data)
+
+
+# The files `aactivator gc` cleans up
+GC_FILES = ('allowed', 'not-now', 'disallowed')
+
+
+def _activate_exists(path):
+    """False only if path/.activate.sh is surely gone: not for, say, permission errors.
+
+    A dangling symlink is still there, as while the venv it points into is rebuilt.
+    """
+    try:
+        os.lstat(os.path.join(path, ACTIVATE))
+    except OSError as error:
+        return error.errno not in (errno.ENOENT, errno.ENOTDIR)
+    return True
+
+
+def collect_garbage(directory, workers=16):
+    """Deduplicate and sort the config files, dropping projects which are gone.
+
+    Returns (name, entries before, entries after) for each of GC_FILES, and
+    for the stamps and restore points of shells which have since exited.  The
+    projects are looked at in parallel, with no lock held, and each file is
+    then rewritten from what's on disk under the lock, so that answers given
+    meanwhile are kept.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    candidates = sorted(frozenset().union(*(
+        _get_lines_if_there(os.path.join(directory, name)) for name in GC_FILES
+    )))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        gone = frozenset(
+            path for path, exists in zip(candidates, pool.map(_activate_exists, candidates))
+            if not exists
+        )
+    results = []
+    for name in GC_FILES:
+        config_file = ConfigFile(directory, name)
+        if os.path.exists(config_file.path):
+            before, after = config_file.update(lambda lines: sorted(lines - gone))
+            results.append((name, before, after))
+    # Only this host's restore points: another's shells can't be seen from here
+    shells = (('stamps', os.path.join(directory, 'stamps')), ('restore', RestorePoints(directory).directory))
+    for name, path in shells:
+        counts = prune_exited_shells(path)
+        if counts is not None:
+            results.append((name,) + counts)
+    return results
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # someone else's, but there
+        return True
+    return True
+
+
+def prune_exited_shells(directory):
+    """Remove the files in directory named for shells which have exited.
+
+    The names start with the shell's pid, as in memo_command's stamps and
+    RestorePoints' files.
+    Returns (entries before, entries after), or None without the directory.
+    """
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return None
+    kept = 0
+    for name in names:
+        pid = name.partition('.')[0].partition('-')[0]
+        if pid.isdigit() and _running(int(pid)):
+            kept += 1
+            continue
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+    return len(names), kept
+
+
+# Once the stamps directory passes this many bytes (and has doubled since the
+# last time), the hook removes the stamps of shells which have exited
+STAMPS_GC_SIZE = 16384
+
+
+def collect_garbage_if_large(config, stamps=False):
+    """Run collect_garbage once a config file passes $AACTIVATOR_GC_SIZE bytes.
+
+    To not do it on every prompt when the entries are all still needed, that
+    is only once the file has also doubled since the last time.  With stamps
+    (for the hook, which makes them), the stamps directory is pruned the same
+    way past STAMPS_GC_SIZE, whatever $AACTIVATOR_GC_SIZE: its size stands in
+    for the number of entries, from the stat memo_command already made.
+    """
+    try:
+        threshold = int(config.env.get('AACTIVATOR_GC_SIZE', ''))
+    except ValueError:
+        threshold = None
+    stamps_path = os.path.join(config.path, 'stamps')
+    stamps_stat = config.stats.stat(stamps_path) if stamps else None
+    if threshold is None and (stamps_stat is None or stamps_stat.st_size <= STAMPS_GC_SIZE):
+        return
+    stamp = os.path.join(config.path, 'gc')
+    collected = {}
+    for line in _get_lines_if_there(stamp):
+        name, _, size = line.partition(' ')
+        collected[name] = int(size) if size.isdigit() else 0
+
+    def sizes():
+        result = {}
+        for name in GC_FILES:
+            try:
+                result[name] = os.stat(os.path.join(config.path, name)).st_size
+            except OSError:
+                result[name] = 0
+        return result
+
+    if threshold is not None and any(
+            size > max(threshold, 2 * collected.get(name, 0)) for name, size in sizes().items()
+    ):
+        collect_garbage(config.path)
+        collected.update(sizes())
+    elif stamps_stat is not None and stamps_stat.st_size > max(STAMPS_GC_SIZE, 2 * collected.get('stamps', 0)):
+        prune_exited_shells(stamps_path)
+    else:
+        return
+    if stamps_stat is not None:
+        collected['stamps'] = os.stat(stamps_path).st_size
+    atomic_write(stamp, ''.join(
+        '{0} {1}\n'.format(name, size) for name, size in sorted(collected.items())
+    ).encode())
+
+
+def gc(env):
+    results = collect_garbage(os.path.join(user_cache_dir(env), 'aactivator'))
+    return '\n'.join(
+        '{0}: {1} -> {2} entries'.format(name, before, after)
+        for name, before, after in results
+    )
+
+
+def _scan_directory(path, mounts, dev):
+    """path's subdirectories on its filesystem, and whether it has an .activate.sh"""
+    subdirectories = []
+    has_activate = False
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name == ACTIVATE:
+                    has_activate = True
+                # Never following symlinks, so each directory is seen once
+                elif entry.is_dir(follow_symlinks=False):
+                    if mounts is not None:
+                        if entry.path in mounts:
+                            continue
+                    elif entry.stat(follow_symlinks=False).st_dev != dev:
+                        continue
+                    subdirectories.append(entry.path)
+    except OSError:  # unreadable, or gone already
+        pass
+    return subdirectories, has_activate
+
+
+def find_projects(root, skip_fstypes=(), workers=16):
+    """The directories under root with an .activate.sh, without leaving its filesystem.
+
+    Directories are listed by a pool of threads, with the filesystem boundary
+    taken from the mount table like search_parent_paths, so that only the
+    directories which are mount points cost a stat.
+    """
+    from concurrent.futures import FIRST_COMPLETED
+    from concurrent.futures import ThreadPoolExecutor
+    from concurrent.futures import wait
+    root = os.path.realpath(root)
+    dev = os.stat(root).st_dev
+    mounts = read_mounts()
+    mount_point = mounts and find_mount(mounts, root)
+    if mount_point is not None:
+        mount_dev, fstype = mounts[mount_point]
+        if fstype in skip_fstypes or fstype.partition('.')[0] in skip_fstypes:
+            return []
+        if mount_dev != dev:  # not in the table, as with a btrfs subvolume
+            mounts = None
+    else:
+        mounts = None
+
+    found = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_scan_directory, root, mounts, dev): root}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                subdirectories, has_activate = future.result()
+                if has_activate:
+                    found.append(path)
+                for subdirectory in subdirectories:
+                    pending[pool.submit(_scan_directory, subdirectory, mounts, dev)] = subdirectory
+    return sorted(found)
+
+
+def allow_recursive(env, root, get_input=sys.stdin.readline, _getuid=os.getuid):
+    """`aactivator allow --recursive`: approve every project under root at once"""
+    config = ActivateConfig(env, get_input)
+    if not os.path.isdir(root):
+        exit('aactivator: Not a directory: {0}'.format(root))
+    approved = []
+    skipped = {'already allowed': 0, 'disallowed': 0, 'owned by someone else': 0}
+    for path in find_projects(root, config.skip_fstypes):
+        activate = os.path.join(path, ACTIVATE)
+        activate_stat = config.stats.stat(activate)
+        if activate_stat is None:
+            continue  # a broken symlink
+        elif activate_stat.st_uid != _getuid():
+            skipped['owned by someone else'] += 1
+        elif path in config.allowed:
+            skipped['already allowed'] += 1
+        elif path in config.disallowed:
+            skipped['disallowed'] += 1
+        else:
+            error = security_check(activate, config.stats, start=root)
+            if error:
+                print(error, file=sys.stderr)
+            else:
+                approved.append(path)
+
+    summary = ', '.join('{0} {1}'.format(count, why) for why, count in sorted(skipped.items()) if count)
+    if not approved:
+        return 'aactivator: Nothing to allow under {0}{1}'.format(root, ' ({0})'.format(summary) if summary else '')
+    print(
+        'aactivator will source {0} and {1} at:'.format(ACTIVATE, DEACTIVATE),
+        *approved,
+        sep='\n    ',
+        file=sys.stderr,
+    )
+    if summary:
+        print('and skip the others ({0}).'.format(summary), file=sys.stderr)
+    print('Acceptable? (y)es (n)o: ', file=sys.stderr, end='')
+    sys.stderr.flush()
+    try:
+        response = get_input()
+    except EOFError:
+        response = 'n'
+    if not response.lower().startswith('y'):
+        return ''
+
+    approved = frozenset(approved)
+    config.allowed.update(lambda lines: sorted(lines | approved))
+    if approved & config.not_now.lines:
+        config.not_now.update(lambda lines: sorted(lines - approved))
+    return 'aactivator will remember this: ~/.cache/aactivator/allowed'
 
 
 def path_is_under(path, under):
@@ -149,32 +1170,418 @@ def path_is_under(path, under):
 
 def user_cache_dir(env):
     # stolen from pip.utils.appdirs.user_cache_dir
-    # expanduser doesn't take an env argument -.-
-    from os.path import expanduser
-    orig, os.environ = os.environ, env
+    # expanduser doesn't take an env argument, so expand ~ ourselves
+    path = env.get('XDG_CACHE_HOME', '~/.cache')
+    if path != '~' and not path.startswith('~/'):
+        return os.path.expanduser(path)
+    elif 'HOME' in env:
+        home = env['HOME']
+    else:
+        import pwd
+        home = pwd.getpwuid(os.getuid()).pw_dir
+    return (home.rstrip('/') + path[1:]) or '/'
+
+
+class NegativeCache(object):
+    """Directories known to have no .activate.sh, as of their inode and mtime.
+
+    Adding, removing or renaming anything in a directory changes its mtime, so
+    while that hasn't changed there's no need to look for .activate.sh again.
+    Kept as `<st_ino> <st_mtime_ns> <last used> <path>` lines, shared by every
+    shell: changes are merged with what's on disk and replace it atomically, and
+    the least recently used entries are dropped beyond `size`.
+    """
+
+    size = 4096
+    # Don't trust mtimes this fresh, the directory may change again within the
+    # filesystem's timestamp granularity without its mtime moving
+    racy_ns = 2 * 10 ** 9
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, 'negative')
+        self.entries = self._read()
+        self.changed = {}
+        self.used = set()
+
+    def _read(self):
+        entries = {}
+        for line in _get_lines_if_there(self.path):
+            try:
+                ino, mtime, used, path = line.split(' ', 3)
+                entries[path] = (int(ino), int(mtime), int(used))
+            except ValueError:  # garbled, forget about it
+                continue
+        return entries
+
+    def lacks_activate(self, path, st):
+        """Whether path (as stat'ed now) was already seen without .activate.sh"""
+        entry = self.entries.get(path)
+        if st is None or entry is None or entry[:2] != (st.st_ino, st.st_mtime_ns):
+            return False
+        self.used.add(path)
+        return True
+
+    def add(self, path, st):
+        import time
+        now = time.time_ns()
+        if st is not None and now - st.st_mtime_ns > self.racy_ns:
+            self.changed[path] = (st.st_ino, st.st_mtime_ns, now // 10 ** 9)
+
+    def save(self, ignore=()):
+        """Write out what we learned, if anything"""
+        import time
+        changed = {path: entry for path, entry in self.changed.items() if path not in ignore}
+        if not changed:
+            return
+        now = int(time.time())
+        with ConfigLock(os.path.dirname(self.path)):
+            entries = self._read()
+            for path in self.used:
+                if path in entries:
+                    entries[path] = entries[path][:2] + (now,)
+            entries.update(changed)
+            kept = sorted(entries.items(), key=lambda item: item[1][2], reverse=True)[:self.size]
+            atomic_write(self.path, ''.join(
+                '{0} {1} {2} {3}\n'.format(ino, mtime, used, path)
+                for path, (ino, mtime, used) in sorted(kept)
+            ).encode('UTF-8', 'surrogateescape'))
+        self.entries = dict(kept)
+        self.changed = {}
+
+
+class SlowPaths(object):
+    """Paths which didn't answer within $AACTIVATOR_TIMEOUT_MS, left alone for a while.
+
+    Kept as `<retry at> <failures> <path>` lines: while a path is held, the
+    prompt skips anything under it, and each failure in a row doubles the wait
+    (up to `max_wait` seconds) until it answers in time again.
+    """
+
+    min_wait = 10
+    max_wait = 600
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, 'slow')
+        self.entries = self._read()
+
+    def _read(self):
+        entries = {}
+        for line in _get_lines_if_there(self.path):
+            try:
+                retry, failures, path = line.split(' ', 2)
+                entries[path] = (int(retry), int(failures))
+            except ValueError:  # garbled, forget about it
+                continue
+        return entries
+
+    def _save(self):
+        mkdirp(self.directory)
+        atomic_write(self.path, ''.join(
+            '{0} {1} {2}\n'.format(retry, failures, path)
+            for path, (retry, failures) in sorted(self.entries.items())
+        ).encode('UTF-8', 'surrogateescape'))
+
+    def _covering(self, paths):
+        return [
+            slow for slow in self.entries
+            if any(path_is_under(path, slow) for path in paths)
+        ]
+
+    def held(self, paths, now):
+        """Whether any of paths is under a slow path which isn't due for a retry"""
+        return any(self.entries[slow][0] > now for slow in self._covering(paths))
+
+    def failed(self, path, now):
+        """Remember that path is slow; returns how long it will be left alone"""
+        failures = self.entries.get(path, (0, 0))[1] + 1
+        wait = min(self.min_wait * 2 ** (failures - 1), self.max_wait)
+        self.entries[path] = (int(now) + wait, failures)
+        self._save()
+        return wait
+
+    def recovered(self, paths):
+        """The slow paths above these answered in time"""
+        covering = self._covering(paths)
+        if covering:
+            for slow in covering:
+                del self.entries[slow]
+            self._save()
+
+
+class Profile(object):
+    """Where the time went in one get_output, for $AACTIVATOR_PROFILE.
+
+    Each `mark` ends a phase begun by the previous one, recording its wall time
+    along with the stats and file reads made meanwhile; `write` appends all of
+    it, and whatever was noted about the prompt, as one line of JSON.
+    """
+
+    def __init__(self, path, startup=False):
+        import time
+        self.path = path
+        self.clock = time.perf_counter
+        self.record = {'time': round(time.time(), 3), 'pid': os.getpid()}
+        if startup:
+            # Our CPU time so far: the nearest thing to how long Python took to get going
+            self.record['startup_ms'] = round(time.process_time() * 1000, 3)
+        self.record['phases'] = {}
+        self.start = self._counts(None)
+        self.last = self.start
+
+    def _counts(self, stats):
+        return (self.clock(), stats.calls if stats is not None else 0, _reads[0], _reads[1])
+
+    @staticmethod
+    def _difference(now, then):
+        return {
+            'ms': round((now[0] - then[0]) * 1000, 3),
+            'stats': now[1] - then[1],
+            'reads': now[2] - then[2],
+            'bytes': now[3] - then[3],
+        }
+
+    def mark(self, phase, stats):
+        now = self._counts(stats)
+        self.record['phases'][phase] = self._difference(now, self.last)
+        self.last = now
+
+    def note(self, **fields):
+        self.record.update(fields)
+
+    def timed(self, command, script):
+        """command, made to append how long it ran to the profile (where the shell can tell)"""
+        import json
+        # $EPOCHREALTIME is seconds with microseconds, from bash 5 or zsh's zsh/datetime
+        record = '{"time": %s, "script": %s, "us": %%s}\\n' % (
+            self.record['time'], json.dumps(script),
+        )
+        return ' &&\n'.join((
+            '_aactivator_start="${EPOCHREALTIME/[.,]/}"',
+            command,
+            '{ [ -z "$_aactivator_start" ] || printf %s $((${EPOCHREALTIME/[.,]/} - _aactivator_start)) >> %s || :; '
+            'unset _aactivator_start; }' % (quote(record), quote(self.path)),
+        ))
+
+    def write(self, stats):
+        import json
+        self.record['total'] = self._difference(self._counts(stats), self.start)
+        line = json.dumps(self.record) + '\n'
+        # One write to an O_APPEND file, so that concurrent shells' lines don't interleave
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, line.encode('UTF-8', 'surrogateescape'))
+        finally:
+            os.close(fd)
+
+
+class NullProfile(object):
+    """The Profile when $AACTIVATOR_PROFILE is unset, doing nothing at all"""
+
+    def __bool__(self):
+        return False
+
+    def mark(self, phase, stats):
+        pass
+
+    def note(self, **fields):
+        pass
+
+    def timed(self, command, script):
+        return command
+
+    def write(self, stats):
+        pass
+
+
+NULL_PROFILE = NullProfile()
+
+
+def open_profile(environ, startup=False):
+    path = environ.get('AACTIVATOR_PROFILE')
+    return Profile(path, startup) if path else NULL_PROFILE
+
+
+def config_sizes(config):
+    """The size in bytes of each config file, as a hint of how long reading them takes"""
+    sizes = {}
+    for config_file in (config.allowed, config.not_now, config.disallowed):
+        try:
+            sizes[os.path.basename(config_file.path)] = os.stat(config_file.path).st_size
+        except OSError:
+            sizes[os.path.basename(config_file.path)] = 0
+    return sizes
+
+
+class Histogram(object):
+    """Counts of latencies in buckets 5% apart, to tell percentiles in fixed memory"""
+
+    growth = 1.05
+    smallest = 0.001  # ms
+
+    def __init__(self):
+        import math
+        self.log = math.log
+        self.buckets = {}
+        self.count = 0
+        self.max = 0
+
+    def add(self, ms):
+        bucket = int(self.log(max(ms, self.smallest) / self.smallest) / self.log(self.growth))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.max = max(self.max, ms)
+
+    def percentile(self, percent):
+        """The upper bound of the bucket the percentile falls in"""
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen * 100 >= self.count * percent:
+                return min(self.smallest * self.growth ** (bucket + 1), self.max)
+        return 0
+
+
+class Slowest(object):
+    """The `size` keys with the largest values so far, in fixed memory"""
+
+    def __init__(self, size=10):
+        self.size = size
+        self.values = {}
+
+    def add(self, key, value):
+        if key in self.values:
+            self.values[key] = max(self.values[key], value)
+        elif len(self.values) < self.size:
+            self.values[key] = value
+        else:
+            # A key pushed out here can only come back with a bigger value
+            smallest = min(self.values, key=self.values.get)
+            if value > self.values[smallest]:
+                del self.values[smallest]
+                self.values[key] = value
+
+    def items(self):
+        return sorted(self.values.items(), key=lambda item: -item[1])
+
+
+class ProfileSummary(object):
+    """Latency percentiles from an AACTIVATOR_PROFILE log, read in one pass.
+
+    Histograms are kept by phase, outcome and project; past `max_projects`
+    projects, the rest are counted together as `(other)`.
+    """
+
+    max_projects = 200
+
+    def __init__(self):
+        from collections import defaultdict
+        self.phases = defaultdict(Histogram)
+        self.outcomes = defaultdict(Histogram)
+        self.projects = defaultdict(Histogram)
+        self.directories = Slowest()
+        self.scripts = Slowest()
+        self.prompts = 0
+        self.garbled = 0
+
+    def add(self, record):
+        if 'script' in record:
+            self.scripts.add(record['script'], record['us'] / 1000)
+            return
+        total = record['total']['ms']
+        self.prompts += 1
+        for phase, counts in record.get('phases', {}).items():
+            self.phases[phase].add(counts['ms'])
+        self.phases['total'].add(total)
+        self.outcomes[record.get('outcome', '?')].add(total)
+        project = record.get('found') or '(none)'
+        if project not in self.projects and len(self.projects) >= self.max_projects:
+            project = '(other)'
+        self.projects[project].add(total)
+        if 'pwd' in record:
+            self.directories.add(record['pwd'], total)
+
+    def read(self, lines):
+        import json
+        for line in lines:
+            try:
+                self.add(json.loads(line))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                self.garbled += 1
+        return self
+
+    def report(self):
+        def table(title, histograms):
+            rows = ['', '{0:<40} {1:>8} {2:>9} {3:>9} {4:>9}'.format(title, 'count', 'p50 ms', 'p90 ms', 'p99 ms')]
+            for name, histogram in histograms:
+                rows.append('{0:<40} {1:>8} {2:>9.2f} {3:>9.2f} {4:>9.2f}'.format(
+                    name, histogram.count, *(histogram.percentile(percent) for percent in (50, 90, 99))
+                ))
+            return rows
+
+        def slowest(title, values):
+            return ['', title] + ['{0:>10.2f}  {1}'.format(value, key) for key, value in values.items()]
+
+        lines = ['{0} prompts'.format(self.prompts)]
+        if self.garbled:
+            lines.append('{0} lines could not be read'.format(self.garbled))
+        lines += table('phase', self.phases.items())
+        lines += table('outcome', sorted(self.outcomes.items()))
+        lines += table('project', sorted(self.projects.items(), key=lambda item: -item[1].percentile(90)))
+        lines += slowest('slowest directories (ms)', self.directories)
+        lines += slowest('slowest {0} (ms)'.format(ACTIVATE), self.scripts)
+        return '\n'.join(lines)
+
+
+def summarize_profile(path):
+    """`aactivator stats`: a report on the profile at path"""
+    if not path:
+        exit('aactivator: No profile to read; pass its path or set AACTIVATOR_PROFILE')
     try:
-        return expanduser(env.get('XDG_CACHE_HOME', '~/.cache'))
-    finally:
-        os.environ = orig
+        with open(path) as lines:
+            return ProfileSummary().read(lines).report()
+    except OSError as error:
+        exit('aactivator: Cannot read profile: {0}'.format(error))
 
 
 class ActivateConfig(object):
 
-    def __init__(self, env, get_input):
+    # get_output sets this to its Profile
+    profile = NULL_PROFILE
+    # and this to whether its output activates or deactivates anything
+    transitioned = False
+
+    def __init__(self, env, get_input, stats=None):
         self.env = env
         self.get_input = get_input
+        self.stats = stats or StatCache()
         self.path = os.path.join(user_cache_dir(self.env), 'aactivator')
-        self.allowed = ConfigFile(self.path, 'allowed')
-        self.not_now = ConfigFile(self.path, 'not-now')
-        self.disallowed = ConfigFile(self.path, 'disallowed')
+        self.allowed = self.config_file('allowed')
+        self.not_now = self.config_file('not-now')
+        self.disallowed = self.config_file('disallowed')
+        self.skip_fstypes = frozenset(filter(None, self.env.get('AACTIVATOR_SKIP_FSTYPES', '').split(',')))
+        self.prefetch = bool(self.env.get('AACTIVATOR_PREFETCH'))
+        if self.env.get('AACTIVATOR_NEGATIVE_CACHE'):
+            self.negative = NegativeCache(self.path)
+        else:
+            self.negative = None
+
+    def config_file_class(self, name):
+        if name != 'not-now' and self.env.get('AACTIVATOR_INDEX'):
+            return IndexedConfigFile
+        else:
+            return ConfigFile
+
+    def config_file(self, name):
+        return self.config_file_class(name)(self.path, name)
 
     def refresh_not_now(self, pwd):
-        result = []
-        for path in self.not_now.lines:
-            dirname = os.path.dirname(path)
-            if path_is_under(pwd, dirname):
-                result.append(path)
-        self.not_now.write('w', '\n'.join(result))
+        def unexpired(lines):
+            return sorted(path for path in lines if path_is_under(pwd, os.path.dirname(path)))
+
+        # Only touch the file when something expired; this runs on every prompt
+        if len(unexpired(self.not_now.lines)) != len(self.not_now.lines):
+            self.not_now.update(unexpired)
 
     def _prompt_user(self, path):
         print(
@@ -187,7 +1594,8 @@ class ActivateConfig(object):
             print('Acceptable? (y)es (n)o (N)ever: ', file=sys.stderr, end='')
             sys.stderr.flush()
             try:
-                response = self.get_input()
+                # The user's thinking time doesn't count against $AACTIVATOR_TIMEOUT_MS
+                response = self.stats.untimed(self.get_input)
             # Allow ^D to be "no"
             except EOFError:
                 response = 'n'
@@ -218,74 +1626,461 @@ class ActivateConfig(object):
                 print(file=sys.stderr)
 
     def find_allowed(self, path):
+        return self._search(path, lambda paths: first(paths, self.is_allowed))
+
+    def find_all_allowed(self, path):
+        """Every allowed project path is in, outermost first, for $AACTIVATOR_NESTED"""
+        return self._search(path, lambda paths: [path for path in paths if self.is_allowed(path)][::-1])
+
+    def _search(self, path, search):
         self.refresh_not_now(path)
-        return first(search_parent_paths(path), self.is_allowed)
+        self.profile.mark('not_now', self.stats)
+        paths = search_parent_paths(path, self.stats, self.skip_fstypes)
+        if self.prefetch:
+            # Everything is_allowed and security_check look at, in one round trip;
+            # all there already from prefetch_ancestors, unless $PWD was a symlink
+            paths = list(paths)
+            self.stats.prefetch(
+                probe for parent in paths for probe in (parent, os.path.join(parent, ACTIVATE))
+            )
+            self.profile.mark('prefetch', self.stats)
+        found = search(paths)
+        if self.negative is not None:
+            # $PWD is the likeliest to keep changing, and costs just one stat
+            self.negative.save(ignore=(path,))
+        self.profile.mark('walk', self.stats)
+        return found
 
     def is_allowed(self, path, _getuid=os.getuid):
         activate = os.path.join(path, ACTIVATE)
-        if not os.path.exists(activate):
+        if self.negative is not None:
+            directory_stat = self.stats.stat(path)
+            if self.negative.lacks_activate(path, directory_stat):
+                return False
+            # Only where there's no entry at all: the target of a dangling
+            # symlink (to a venv not made yet, say) can appear without the
+            # directory changing
+            if self.stats.lstat(activate) is None:
+                self.negative.add(path, directory_stat)
+                return False
+        try:
+            activate_stat = self.stats.stat(activate)
+        except OSError:
+            activate_stat = None
+        if activate_stat is None:
             return False
-        elif os.stat(activate).st_uid != _getuid():
+        elif activate_stat.st_uid != _getuid():
             # If we do not own this path, short circuit on activating
             return False
-        elif path in self.disallowed.lines or path in self.not_now.lines:
+        elif path in self.disallowed or path in self.not_now:
             return False
-        elif path in self.allowed.lines:
+        elif path in self.allowed:
             return True
         else:
             return self._prompt_user(path)
 
 
-def security_check(path):
-    if not os.path.exists(path):
-        return 'aactivator: File does not exist: ' + path
-    insecure_path = insecure(path)
+def security_check(path, stats=None, start=None):
+    """Why path mustn't be sourced, if it mustn't; paths in the message are relative to start"""
+    stats = stats or StatCache()
+    if stats.stat(path) is None:
+        return 'aactivator: File does not exist: ' + (path if start is None else relpath(path, start))
+    insecure_path = insecure(path, stats)
     if insecure_path is not None:
         return (
             'aactivator: Cowardly refusing to source {0} because writeable by others: {1}'
-            .format(relpath(path), relpath(insecure_path))
+            .format(relpath(path, start or os.curdir), relpath(insecure_path, start or os.curdir))
         )
 
 
-def command_for_path(cmd, path, pwd):
-    if path == pwd:
-        return cmd
+def in_project(path, command):
+    """command, run from path and back; at the top level, rather than in a function"""
+    return '_aactivator_enter {0} && {1}; _aactivator_leave'.format(quote(path), command)
+
+
+# Variables which change under .activate.sh without it having anything to do with it
+_UNTRACKED = frozenset(('PWD', 'OLDPWD', 'SHLVL', '_'))
+
+
+def tracked_environment(environ):
+    return {
+        name: value for name, value in environ.items()
+        if name not in _UNTRACKED and not name.startswith('AACTIVATOR_')
+    }
+
+
+# Prints the shell's aliases in a form it can read back
+_ALIASES = '{ if [ "$ZSH_VERSION" ]; then alias -L; else alias; fi; }'
+# `# aactivator-depends: FILE...` in .activate.sh: files whose changes change what it does
+_DEPENDS = '# aactivator-depends:'
+
+
+class EnvSnapshots(object):
+    """What sourcing each .activate.sh does to the environment, for $AACTIVATOR_ENV_CACHE.
+
+    The first time, the shell reports its exported variables and aliases to
+    `aactivator env-record` just before and after sourcing .activate.sh; after
+    that, activating replays the difference instead of sourcing it again.
+    Snapshots are keyed on the contents of .activate.sh and of the files it
+    names on `# aactivator-depends:` lines.  Variables which gained a prefix or
+    suffix at a `:` (PATH, say) are replayed as such, on top of their value at
+    the time.  Unexported variables and functions are not captured.
+    """
+
+    def __init__(self, directory, arg0):
+        self.directory = os.path.join(directory, 'env')
+        self.arg0 = arg0
+
+    def key(self, path):
+        """Identifies path/.activate.sh and its dependencies as they are now"""
+        import hashlib
+        digest = hashlib.sha256(_encode(path) + b'\0')
+        with open(os.path.join(path, ACTIVATE), 'rb') as file_obj:
+            script = file_obj.read()
+        digest.update(script)
+        for line in script.decode('UTF-8', 'surrogateescape').splitlines():
+            if line.startswith(_DEPENDS):
+                for dependency in line[len(_DEPENDS):].split():
+                    digest.update(b'\0' + _encode(dependency) + b'\0')
+                    try:
+                        with open(os.path.join(path, dependency), 'rb') as file_obj:
+                            digest.update(file_obj.read())
+                    except OSError:
+                        digest.update(b'\0missing')
+        return digest.hexdigest()
+
+    def path(self, key, suffix=''):
+        return os.path.join(self.directory, key + suffix + '.json')
+
+    def record_command(self, stage, key):
+        # Not worth failing the activation over
+        return '{{ {0} | {1} env-record {2} {3} >/dev/null || :; }}'.format(_ALIASES, quote(self.arg0), stage, key)
+
+    def record(self, stage, key, environ, aliases):
+        """`aactivator env-record`: take note of the environment before or after sourcing"""
+        import json
+        environ = tracked_environment(environ)
+        aliases = aliases.splitlines()
+        # The environment is nobody else's business
+        mkdirp(self.directory)
+        os.chmod(self.directory, 0o700)
+        if stage == 'before':
+            atomic_write(self.path(key, '.before'), json.dumps([environ, aliases]).encode())
+            return
+        try:
+            with open(self.path(key, '.before')) as file_obj:
+                before, before_aliases = json.load(file_obj)
+            os.remove(self.path(key, '.before'))
+        except (OSError, ValueError):
+            return
+        changes = []
+        for name in sorted(set(before) | set(environ)):
+            old, new = before.get(name), environ.get(name)
+            if new is None:
+                changes.append((name, 'unset', None))
+            elif old is None or old == new:
+                if old != new:
+                    changes.append((name, 'set', new))
+            elif old and new.endswith(':' + old):
+                changes.append((name, 'prepend', new[:-len(old)]))
+            elif old and new.startswith(old + ':'):
+                changes.append((name, 'append', new[len(old):]))
+            else:
+                changes.append((name, 'set', new))
+        added_aliases = [line for line in aliases if line not in set(before_aliases)]
+        atomic_write(self.path(key), json.dumps({'env': changes, 'aliases': added_aliases}).encode())
+
+    def replay(self, key, stats=None):
+        """Shell code redoing what sourcing did, if we know and it's safe"""
+        import json
+        stats = stats or StatCache()
+        path = self.path(key)
+        if stats.stat(path) is None or insecure(path, stats) is not None:
+            return None
+        try:
+            with open(path) as file_obj:
+                snapshot = json.load(file_obj)
+        except (OSError, ValueError):
+            return None
+        commands = []
+        for name, change, value in snapshot['env']:
+            if not name.isidentifier():
+                continue
+            elif change == 'unset':
+                commands.append('unset ' + name)
+            elif change == 'prepend':
+                commands.append('export {0}={1}"${0}"'.format(name, quote(value)))
+            elif change == 'append':
+                commands.append('export {0}="${0}"{1}'.format(name, quote(value)))
+            else:
+                commands.append('export {0}={1}'.format(name, quote(value)))
+        return ' &&\n'.join(commands + snapshot['aliases'])
+
+
+# What `export -p` quoting looks like in $'...', as zsh uses for some values
+_C_ESCAPES = {'a': '\a', 'b': '\b', 'e': '\x1b', 'E': '\x1b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+
+
+def _escaped_byte(value):
+    # As surrogateescape would decode it, for parse_exports to decode again with its neighbours
+    return chr(value) if value < 0x80 else chr(0xdc00 + (value & 0xff))
+
+
+def _c_escape(text, i):
+    """The character a $'...' escape starting at text[i] (just past the backslash) stands for, and where it ends"""
+    c = text[i]
+    if c in _C_ESCAPES:
+        return _C_ESCAPES[c], i + 1
+    elif c in '01234567':
+        end = i
+        while end < i + 3 and end < len(text) and text[end] in '01234567':
+            end += 1
+        return _escaped_byte(int(text[i:end], 8)), end
+    elif c in 'xuU':
+        end = start = i + 1
+        while end < start + {'x': 2, 'u': 4, 'U': 8}[c] and end < len(text) and text[end] in _HEX_DIGITS:
+            end += 1
+        if end == start:
+            return '\\' + c, start
+        value = int(text[start:end], 16)
+        return (_escaped_byte(value) if c == 'x' else chr(value)), end
+    elif c == 'c' and i + 1 < len(text):
+        return chr(ord(text[i + 1]) & 0x1f), i + 2
     else:
+        return c, i + 1
+
+
+def _shell_words(text):
+    """Each line of text as a list of words, undoing the quoting `export -p` uses"""
+    lines, words, word = [], [], None
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c in ' \t\n':
+            if word is not None:
+                words.append(word)
+                word = None
+            if c == '\n' and words:
+                lines.append(words)
+                words = []
+            i += 1
+        elif c == '\\':
+            if text[i + 1:i + 2] != '\n':
+                word = (word or '') + text[i + 1:i + 2]
+            i += 2
+        elif c == "'":
+            end = text.find("'", i + 1)
+            end = len(text) if end < 0 else end
+            word = (word or '') + text[i + 1:end]
+            i = end + 1
+        elif c == '"':
+            word = word or ''
+            i += 1
+            while i < len(text) and text[i] != '"':
+                if text[i] == '\\' and text[i + 1:i + 2] in ('$', '`', '"', '\\', '\n'):
+                    word += text[i + 1].strip('\n')
+                    i += 2
+                else:
+                    word += text[i]
+                    i += 1
+            i += 1
+        elif text.startswith("$'", i):
+            word = word or ''
+            i += 2
+            while i < len(text) and text[i] != "'":
+                if text[i] == '\\' and i + 1 < len(text):
+                    escaped, i = _c_escape(text, i + 1)
+                    word += escaped
+                else:
+                    word += text[i]
+                    i += 1
+            i += 1
+        else:
+            word = (word or '') + c
+            i += 1
+    if word is not None:
+        words.append(word)
+    if words:
+        lines.append(words)
+    return lines
+
+
+def parse_exports(text):
+    """{name: value} from the output of `export -p`, as bash, zsh or sh print it"""
+    exports = {}
+    for words in _shell_words(text):
+        if words[0] not in ('declare', 'export', 'typeset'):
+            continue
+        options, rest = '', words[1:]
+        while rest and rest[0].startswith('-'):
+            options += rest.pop(0)
+        if 'T' in options and len(rest) >= 2 and rest[1].endswith('=('):
+            # zsh's tied scalars, `export -T PATH path=( /a /b )`
+            elements = rest[2:]
+            exports[rest[0]] = ':'.join(elements[:elements.index(')')] if ')' in elements else elements)
+            continue
+        for word in rest:
+            name, equals, value = word.partition('=')
+            if equals:  # not just declared
+                exports[name] = value
+    # Bytes escaped one by one, as in $'\303\251', put back together
+    return {
+        name: value.encode('UTF-8', 'surrogateescape').decode('UTF-8', 'surrogateescape')
+        for name, value in exports.items()
+    }
+
+
+class RestorePoints(object):
+    """What activating each project changed, where there's no .deactivate.sh to undo it.
+
+    Just before and after sourcing .activate.sh, the shell writes `export -p`
+    to a file (a builtin, so no more processes), and lists the pair in
+    $AACTIVATOR_PENDING.  The next time aactivator runs anyway, it compares
+    the two, notes the changes in $AACTIVATOR_RESTORE for deaactivate, and
+    removes the pair.  The files are only readable by the user, and named for
+    the shell's pid under a directory for the host; `aactivator gc` removes
+    those of shells which exited before that.
+    """
+
+    def __init__(self, directory, pid=None):
+        self.directory = os.path.join(directory, 'restore', os.uname().nodename)
+        self.pid = pid or str(os.getppid())
+
+    @staticmethod
+    def key(path):
+        import hashlib
+        return hashlib.sha256(_encode(path)).hexdigest()[:16]
+
+    def capture(self, path, source):
+        """source, noting the environment around it for settle"""
+        try:
+            # The environment is nobody else's business
+            os.makedirs(self.directory, 0o700)
+        except FileExistsError:
+            pass
+        entry = '{0}-{1}'.format(self.pid, self.key(path))
+        for suffix in ('.before', '.after'):
+            # For the shell to write over, which keeps the mode
+            fd = os.open(
+                os.path.join(self.directory, entry + suffix),
+                os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600,
+            )
+            try:
+                os.fchmod(fd, 0o600)
+            finally:
+                os.close(fd)
+        files = quote(os.path.join(self.directory, entry))
         return ' &&\n'.join((
-            'OLDPWD_bak="$OLDPWD"',
-            'cd ' + quote(path),
-            cmd,
-            'cd "$OLDPWD_bak"',
-            'cd ' + quote(pwd),
-            'unset OLDPWD_bak',
+            'export -p >| {0}.before'.format(files),
+            source,
+            'export -p >| {0}.after'.format(files),
+            'export {0}="${{{0}:+${0} }}{1}"'.format(PENDING_VARIABLE, entry),
         ))
 
+    def _read(self, name):
+        with open(os.path.join(self.directory, name), encoding='UTF-8', errors='surrogateescape') as file_obj:
+            text = file_obj.read()
+        _reads[0] += 1
+        _reads[1] += len(text)
+        return tracked_environment(parse_exports(text))
+
+    def settle(self, pending, projects):
+        """{project: [[name, previous value or None], ...]} from the pending captures of projects.
+
+        This shell's captures are removed once read; those inherited from
+        another shell are left for it.
+        """
+        keys = {self.key(path): path for path in projects}
+        noted = {}
+        for entry in pending.split():
+            pid, _, key = entry.partition('-')
+            path = keys.get(key)
+            if path is None:
+                continue
+            try:
+                before, after = self._read(entry + '.before'), self._read(entry + '.after')
+            except OSError:
+                continue
+            if pid == self.pid:
+                for suffix in ('.before', '.after'):
+                    try:
+                        os.remove(os.path.join(self.directory, entry + suffix))
+                    except FileNotFoundError:
+                        pass
+            noted[path] = [
+                [name, before.get(name)]
+                for name in sorted(set(before) | set(after))
+                if name.isidentifier() and before.get(name) != after.get(name)
+            ]
+        return noted
+
+
+def noted_changes(environ):
+    """{project: [[name, previous value or None], ...]} as noted by RestorePoints"""
+    import json
+    try:
+        noted = json.loads(environ.get(RESTORE_VARIABLE, '{}'))
+    except ValueError:
+        return {}
+    return noted if isinstance(noted, dict) else {}
 
-def aactivate(path, pwd):
-    return command_for_path(
-        ' &&\n'.join((
-            'aactivator security-check ' + ACTIVATE,
-            'source ./' + ACTIVATE,
-            'export %s=%s' % (ENVIRONMENT_VARIABLE, quote(path)),
-        )),
-        path,
-        pwd,
-    )
+
+def restore_variable_command(noted):
+    import json
+    if noted:
+        return 'export {0}={1}'.format(
+            RESTORE_VARIABLE, quote(json.dumps(noted, separators=(',', ':'), sort_keys=True)),
+        )
+    else:
+        return 'unset ' + RESTORE_VARIABLE
+
+
+def restore_commands(changed):
+    """Undo changes noted by RestorePoints"""
+    return [
+        'unset ' + name if value is None else 'export {0}={1}'.format(name, quote(value))
+        for name, value in changed
+        if name.isidentifier()
+    ]
+
+
+def aactivate(path, stats=None, profile=NULL_PROFILE, snapshots=None, restore=None):
+    # Checked right here, rather than by another aactivator run from the script
+    stats = stats or StatCache()
+    error = security_check(os.path.join(path, ACTIVATE), stats, start=path)
+    if error:
+        return 'echo %s >&2 &&\nfalse' % quote(error)
+    source = profile.timed('source ./' + ACTIVATE, os.path.join(path, ACTIVATE))
+    if snapshots is not None:
+        key = snapshots.key(path)
+        replay = snapshots.replay(key, stats)
+        if replay is None:
+            source = ' &&\n'.join((
+                snapshots.record_command('before', key),
+                source,
+                snapshots.record_command('after', key),
+            ))
+        else:
+            source = replay or ':'
+    if restore is not None and stats.stat(os.path.join(path, DEACTIVATE)) is None:
+        # Nothing to undo this with, so remember what it did
+        source = restore.capture(path, source)
+    return '{{ {0}; }} &&\nexport {1}={2}'.format(in_project(path, source), ENVIRONMENT_VARIABLE, quote(path))
 
 
-def deaactivate(path, pwd):
+def deaactivate(path, stats=None, changed=None):
+    stats = stats or StatCache()
     unset = 'unset ' + ENVIRONMENT_VARIABLE
     deactivate_path = os.path.join(path, DEACTIVATE)
 
-    if os.path.exists(deactivate_path):
-        return command_for_path(
-            ' &&\n'.join((
-                'aactivator security-check ' + DEACTIVATE,
-                'source ./' + DEACTIVATE,
-            )) + '\n' + unset,
-            path,
-            pwd,
-        )
+    if stats.stat(deactivate_path) is not None:
+        error = security_check(deactivate_path, stats, start=path)
+        if error:
+            return 'echo %s >&2\n' % quote(error) + unset
+        return '{{ {0}; {1}; }}'.format(in_project(path, 'source ./' + DEACTIVATE), unset)
+    elif changed is not None:
+        return '\n'.join(restore_commands(changed) + [unset])
     else:
         return ' &&\n'.join((
             unset,
@@ -293,46 +2088,478 @@ def deaactivate(path, pwd):
         ))
 
 
-def get_output(environ, pwd='.', get_input=sys.stdin.readline, arg0='/path/to/aactivator'):
+def active_stack(environ):
+    """The projects which are active, outermost first"""
+    active = environ.get(ENVIRONMENT_VARIABLE)
+    if not active:
+        return []
+    if STACK_VARIABLE in environ:
+        import json
+        try:
+            stack = json.loads(environ[STACK_VARIABLE])
+        except ValueError:
+            stack = None
+        # Unless someone deactivated by hand since
+        if isinstance(stack, list) and stack[-1:] == [active]:
+            return stack
+    return [active]
+
+
+def stack_command(stack, nested=True):
+    """Record stack as the active projects, after whatever was left or entered"""
+    import json
+    if nested and stack:
+        return 'export {0}={1} {2}={3}'.format(
+            STACK_VARIABLE, quote(json.dumps(stack, separators=(',', ':'))),
+            ENVIRONMENT_VARIABLE, quote(stack[-1]),
+        )
+    elif stack:
+        return 'unset {0} &&\nexport {1}={2}'.format(STACK_VARIABLE, ENVIRONMENT_VARIABLE, quote(stack[-1]))
+    else:
+        return 'unset ' + STACK_VARIABLE
+
+
+def watched_paths(config, pwd, activate_path):
+    """The paths whose modification could change the answer for this pwd"""
+    watched = [config.path, config.allowed.path, config.not_now.path, config.disallowed.path]
+    for path in search_parent_paths(pwd, config.stats, config.skip_fstypes):
+        watched.append(path)
+        if path == activate_path:
+            watched.append(os.path.join(path, ACTIVATE))
+            break
+    return watched
+
+
+def memo_command(config, pwd, activate_path):
+    """Shell state letting the hook skip us until something we looked at changes.
+
+    The hook reruns when $PWD or the environment differ from the memo, or when
+    a watched path is newer than its stamp: the config files (and directory),
+    each directory searched for .activate.sh, and the .activate.sh we found.
+    """
+    watched = watched_paths(config, pwd, activate_path)
+    stamps = os.path.join(config.path, 'stamps')
+    if config.stats.stat(stamps) is None:
+        mkdirp(stamps)
+    return ' &&\n'.join((
+        '_aactivator_watch=(%s)' % ' '.join(quote(path) for path in watched),
+        '_aactivator_stamp=%s/$$' % quote(stamps),
+        '_aactivator_memo=' + MEMO_KEY,
+    ))
+
+
+def _case_function(name, patterns, body='return 0;; esac; return 1'):
+    if not patterns:
+        return '%s() { return 1; }\n' % name
+    return '%s() { case "$1" in %s) %s; }\n' % (name, '|'.join(patterns), body)
+
+
+def render_snapshot(config, path):
+    """Shell functions answering `init --mode=fast` from our config files"""
+    allowed, not_now, disallowed = (
+        ConfigFile(config.path, name).lines for name in ('allowed', 'not-now', 'disallowed')
+    )
+    sources = (config.allowed.path, config.not_now.path, config.disallowed.path)
+    # The answers for not-now paths only hold until we leave their parent directory
+    holds = sorted(set(
+        '  case "$PWD/" in %s/*) ;; *) return 1;; esac\n' % quote(os.path.dirname(line))
+        for line in not_now
+        if os.path.dirname(line) != '/'
+    ))
+    return ''.join((
+        '# Generated by aactivator, from the files in this directory\n',
+        '_aactivator_snapshot_stale() { %s; }\n' % ' || '.join(
+            '[ %s -nt %s ]' % (quote(source), quote(path)) for source in sources
+        ),
+        _case_function('_aactivator_allowed', sorted(quote(line) for line in allowed)),
+        _case_function(
+            '_aactivator_declined', sorted(quote(line) for line in disallowed | not_now),
+        ),
+        '_aactivator_not_now_holds() {\n', ''.join(holds), '  return 0\n}\n',
+    ))
+
+
+def snapshot_command(config):
+    """Refresh the snapshot read by `init --mode=fast`, and have the shell load it"""
+    path = os.path.join(config.path, 'snapshot.sh')
+    try:
+        generated = os.stat(path).st_mtime_ns
+    except OSError:
+        generated = None
+    # Not the StatCache: answering a prompt may have just changed the config files
+    for source in (config.allowed.path, config.not_now.path, config.disallowed.path):
+        try:
+            modified = os.stat(source).st_mtime_ns
+        except OSError:
+            continue
+        if generated is not None and modified >= generated:
+            generated = None
+    if generated is None:
+        mkdirp(config.path)
+        atomic_write(path, render_snapshot(config, path).encode('UTF-8', 'surrogateescape'))
+    return '_aactivator_snapshot=%s &&\n. "$_aactivator_snapshot"' % quote(path)
+
+
+def timeout_seconds(environ):
+    """$AACTIVATOR_TIMEOUT_MS, if it's set to something sensible"""
     try:
-        pwd = os.path.realpath(pwd)
+        timeout = float(environ.get('AACTIVATOR_TIMEOUT_MS', ''))
+    except ValueError:
+        return None
+    return timeout / 1000 if timeout > 0 else None
+
+
+def get_output(
+        environ, pwd='.', get_input=sys.stdin.readline, arg0='/path/to/aactivator', memo=False,
+        stats=None, mode='default', trigger='prompt', profile=None, _config=ActivateConfig,
+):
+    profile = profile or open_profile(environ)
+    timeout = timeout_seconds(environ)
+    stats = stats or StatCache(timeout)
+    if timeout is None:
+        output = _get_output(environ, pwd, get_input, arg0, memo, stats, mode, trigger, profile, _config)
+    else:
+        import time
+        slow = SlowPaths(os.path.join(user_cache_dir(environ), 'aactivator'))
+        try:
+            involved = [os.path.abspath(pwd)]
+        except OSError as error:
+            if error.errno == errno.ENOENT:  # $PWD was deleted
+                profile.note(outcome='missing')
+                profile.write(stats)
+                return ''
+            else:
+                raise
+        if environ.get(ENVIRONMENT_VARIABLE):
+            involved.append(environ[ENVIRONMENT_VARIABLE])
+        if slow.held(involved, time.time()):
+            profile.note(outcome='held')
+            output = ''
+        else:
+            try:
+                output = _get_output(environ, pwd, get_input, arg0, memo, stats, mode, trigger, profile, _config)
+            except SlowFilesystem as error:
+                path = error.path
+                if os.path.basename(path) in (ACTIVATE, DEACTIVATE):
+                    path = os.path.dirname(path)
+                profile.note(outcome='slow', slow=path)
+                if path == '/' or stats.answered(error.path):
+                    # Not the path's fault, and holding it would hold far too much
+                    output = 'echo %s >&2' % quote(
+                        'aactivator: gave up after {0}ms'.format(environ['AACTIVATOR_TIMEOUT_MS']),
+                    )
+                else:
+                    wait = slow.failed(path, time.time())
+                    output = 'echo %s >&2' % quote(
+                        'aactivator: {0} did not answer within {1}ms, leaving it alone for {2}s'.format(
+                            path, environ['AACTIVATOR_TIMEOUT_MS'], wait,
+                        ),
+                    )
+            else:
+                slow.recovered(involved)
+    profile.write(stats)
+    return output
+
+
+def _get_output(environ, pwd, get_input, arg0, memo, stats, mode, trigger, profile, _config):
+    try:
+        if environ.get('AACTIVATOR_PREFETCH'):
+            prefetch_ancestors(os.path.abspath(pwd), stats)
+        pwd = stats.realpath(pwd)
     except OSError as error:
-        if error.errno == 2:  # no such file
+        if error.errno == errno.ENOENT:
+            profile.note(outcome='missing')
             return ''
         else:
             raise
-    config = ActivateConfig(environ, get_input)
-    activate_path = config.find_allowed(pwd)
+    profile.mark('realpath', stats)
+    config = _config(environ, get_input, stats)
+    config.profile = profile
+    profile.mark('config', stats)
+    nested = bool(environ.get('AACTIVATOR_NESTED'))
+    if nested:
+        stack = config.find_all_allowed(pwd)
+    else:
+        stack = list(filter(None, [config.find_allowed(pwd)]))
+    activate_path = stack[-1] if stack else None
     result = []
 
-    if environ.get('AACTIVATOR_VERSION') == __version__:
-        activated_env = environ.get(ENVIRONMENT_VARIABLE)
+    reinit = environ.get('AACTIVATOR_VERSION') != __version__
+    if not reinit:
+        activated = active_stack(environ)
     else:
-        result.append(init(arg0))
-        activated_env = None
-
-    if activated_env != activate_path:  # did we already activate the current environment?
-        if activated_env:  # deactivate it
-            result.append(deaactivate(activated_env, pwd))
-        if activate_path:
-            result.append(aactivate(activate_path, pwd))
+        result.append(init(arg0, mode, trigger))
+        activated = []
+    activated_env = activated[-1] if activated else None
+
+    # Only the levels being left are deactivated, and only those being entered activated
+    kept = 0
+    while kept < min(len(stack), len(activated)) and stack[kept] == activated[kept]:
+        kept += 1
+    leaving, entering = activated[kept:], stack[kept:]
+    transitions = []
+    restore = RestorePoints(config.path, environ.get(SHELL_PID_VARIABLE))
+    noted = noted_changes(environ) if RESTORE_VARIABLE in environ else {}
+    pending = environ.get(PENDING_VARIABLE)
+    if pending:
+        noted.update(restore.settle(pending, active_stack(environ)))
+    restored = any(path in noted for path in leaving)
+    for path in reversed(leaving):
+        transitions.append(deaactivate(path, config.stats, noted.pop(path, None)))
+    if entering:
+        if environ.get('AACTIVATOR_ENV_CACHE'):
+            snapshots = EnvSnapshots(config.path, arg0)
+        else:
+            snapshots = None
+        for path in entering:
+            transitions.append(aactivate(path, config.stats, profile, snapshots, restore))
+    # Before anything entered adds to them again
+    if pending or restored:
+        result.append(restore_variable_command(noted))
+    if pending:
+        result.append('unset ' + PENDING_VARIABLE)
+    result.extend(transitions)
+    config.transitioned = bool(transitions)
+    if stack != activated and (nested or STACK_VARIABLE in environ):
+        result.append(stack_command(stack, nested))
+    if memo:
+        # Any parent could gain an .activate.sh and add a level, so watch them all
+        result.append(memo_command(config, pwd, None if nested else activate_path))
+    if mode == 'fast':
+        result.append(snapshot_command(config))
+    profile.mark('render', stats)
+    collect_garbage_if_large(config, stamps=memo)
+    if profile:
+        profile.note(
+            pwd=pwd,
+            found=activate_path,
+            outcome=(
+                'none' if activated_env == activate_path else
+                'activate' if not activated_env else
+                'deactivate' if not activate_path else
+                'switch'
+            ),
+            init=reinit,
+            config_bytes=config_sizes(config),
+        )
     return ' &&\n'.join(result)
 
 
+def file_signature(path):
+    """Changes whenever the file at path is replaced, modified, or chmod'ed"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+
+class NeedsPrompt(Exception):
+    """The answer depends on the user, so it has to come from their terminal"""
+
+
+class ServedConfig(ActivateConfig):
+    """An ActivateConfig which reuses a server's parsed config files and never prompts"""
+
+    def __init__(self, env, get_input, server, stats=None):
+        self.server = server
+        super(ServedConfig, self).__init__(env, get_input, stats)
+        server.last_config = self
+
+    def config_file(self, name):
+        return self.server.config_file(self.path, name, self.config_file_class(name))
+
+    def find_allowed(self, path):
+        self.found = super(ServedConfig, self).find_allowed(path)
+        return self.found
+
+    def find_all_allowed(self, path):
+        # Any parent could gain an .activate.sh and add a level, so watch them all
+        self.found = None
+        return super(ServedConfig, self).find_all_allowed(path)
+
+    def _prompt_user(self, path):
+        raise NeedsPrompt(path)
+
+
+class Server(object):
+    """Answers prompt hooks over a unix socket, from a warm interpreter.
+
+    Parsed config files and whole answers are kept in LRU caches, and reused
+    for as long as the files they were read from (see `watched_paths`) are
+    unchanged.  Answers which activate or deactivate anything aren't kept, so
+    that what they source always gets its security_check.  Anything needing a
+    prompt gets an empty reply, which makes the hook fall back to running
+    aactivator on the user's terminal.
+    """
+
+    def __init__(self, path, max_size=1024):
+        from collections import OrderedDict
+        self.path = path
+        self.max_size = max_size
+        self.config_files = OrderedDict()
+        self.outputs = OrderedDict()
+        self.last_config = None
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.max_size:
+            cache.popitem(last=False)
+
+    def config_file(self, directory, name, config_file_class=ConfigFile):
+        key = (os.path.join(directory, name), config_file_class)
+        signature = file_signature(key[0])
+        cached = self.config_files.get(key)
+        if cached is None or cached[0] != signature:
+            cached = (signature, config_file_class(directory, name))
+        self._remember(self.config_files, key, cached)
+        return cached[1]
+
+    def get_output(self, environ, pwd, arg0, options=None):
+        options = options or {}
+        key = (pwd, arg0, tuple(sorted(environ.items())), tuple(sorted(options.items())))
+        cached = self.outputs.get(key)
+        if cached is not None:
+            realpwd, signatures, output = cached
+            if (
+                    os.path.realpath(pwd) == realpwd and
+                    all(file_signature(path) == signature for path, signature in signatures)
+            ):
+                self.outputs.move_to_end(key)
+                return output
+
+        self.last_config = None
+        try:
+            output = get_output(
+                environ, pwd, arg0=arg0, memo=True,
+                _config=lambda env, get_input, stats: ServedConfig(env, get_input, self, stats),
+                **options
+            )
+        except NeedsPrompt:
+            return ''
+        config, realpwd = self.last_config, os.path.realpath(pwd)
+        # Whatever gets sourced is checked afresh each time; the environment
+        # changes once it has been, so such answers are rarely asked for twice
+        if config is None or config.stats.timed_out or config.transitioned or environ.get(PENDING_VARIABLE):
+            return output
+        signatures = tuple(
+            (path, file_signature(path))
+            for path in watched_paths(config, realpwd, config.found)
+        )
+        self._remember(self.outputs, key, (realpwd, signatures, output))
+        return output
+
+    def handle(self, conn):
+        """One request: NUL-separated pwd, arg0, init's --options and NAME=value items, then EOF"""
+        data = b''
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        fields = os.fsdecode(data).split('\0')
+        if len(fields) < 2:
+            return
+        pwd, arg0 = fields[:2]
+        options = parse_options(item for item in fields[2:] if item.startswith('--'))
+        if options is None:
+            return
+        environ = {}
+        for item in fields[2:]:
+            name, _, value = item.partition('=')
+            if value and not item.startswith('--'):
+                environ[name] = value
+        conn.sendall(os.fsencode(self.get_output(environ, pwd, arg0, options)))
+
+    def serve_forever(self):
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except OSError:
+            if os.path.exists(self.path):
+                os.unlink(self.path)  # left behind by a server which died
+        else:
+            return 'aactivator: Already serving on ' + self.path
+        finally:
+            probe.close()
+
+        old_umask = os.umask(0o077)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        sock.listen(64)
+        os.chdir('/')
+        try:
+            while True:
+                conn, _ = sock.accept()
+                try:
+                    if _peer_uid(conn) in (None, os.getuid()):
+                        self.handle(conn)
+                except OSError:
+                    pass
+                finally:
+                    conn.close()
+        finally:
+            sock.close()
+            os.unlink(self.path)
+
+
+def _peer_uid(conn):
+    import socket
+    import struct
+    if not hasattr(socket, 'SO_PEERCRED'):  # pragma: no cover (not linux)
+        return None
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def serve(env):
+    import signal
+    if not env.get('XDG_RUNTIME_DIR'):
+        return 'aactivator: XDG_RUNTIME_DIR must be set to serve'
+    # Clean up the socket when stopped, e.g. by systemd
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    return Server(os.path.join(env['XDG_RUNTIME_DIR'], SOCKET)).serve_forever()
+
+
 def aactivator(args, env):
-    if len(args) == 1:
-        return get_output(env, arg0=args[0])
-    elif len(args) == 2 and args[1] == 'init':
-        return init(args[0])
+    if len(args) >= 2 and args[1] == 'init':
+        options = parse_options(args[2:])
+        if options is not None:
+            return init(args[0], **options)
     elif len(args) == 3 and args[1] == 'security-check':
         exit(security_check(args[2]))
+    elif len(args) == 2 and args[1] == 'serve':
+        exit(serve(env))
+    elif len(args) == 4 and args[1] == 'env-record' and args[2] in ('before', 'after'):
+        EnvSnapshots(os.path.join(user_cache_dir(env), 'aactivator'), args[0]).record(
+            args[2], args[3], env, sys.stdin.read(),
+        )
+        return ''
+    elif len(args) == 4 and args[1:3] == ('allow', '--recursive'):
+        return allow_recursive(env, args[3], sys.stdin.readline)
+    elif len(args) == 2 and args[1] == 'gc':
+        return gc(env)
+    elif len(args) in (2, 3) and args[1] == 'stats':
+        return summarize_profile(args[2] if len(args) == 3 else env.get('AACTIVATOR_PROFILE'))
     else:
-        return __doc__ + '\nVersion: ' + __version__
+        # The hook, with the options given to init
+        options = parse_options(args[1:])
+        if options is not None:
+            return get_output(env, arg0=args[0], memo=True, profile=open_profile(env, startup=True), **options)
+    return __doc__ + '\nVersion: ' + __version__
 
 
 def main():
+    args = tuple(sys.argv)
+    if args[1:2] and args[1].startswith('--arg0='):  # from launch_command
+        args = (args[1][len('--arg0='):],) + args[2:]
     try:
-        print(aactivator(tuple(sys.argv), os.environ.copy()))
+        print(aactivator(args, os.environ.copy()))
     except KeyboardInterrupt:  # pragma: no cover
         # Silence ^C
         pass
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""\
+Measure how long aactivator takes to answer a prompt.
+
+Builds synthetic directory trees and config files of various sizes, then times
+`get_output` (and counts the filesystem calls it makes) for three cases:
+
+    - hit: the project above $PWD is already active, nothing to do
+    - miss: there is no project anywhere above $PWD
+    - transition: entering an allowed project which isn't active yet
+
+Results are written as JSON, so runs on different commits can be compared:
+
+    $ python bench/latency.py --output before.json
+    $ git checkout my-branch
+    $ python bench/latency.py --output after.json
+    $ python bench/latency.py --compare before.json after.json
+"""
+import argparse
+import builtins
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import aactivator  # noqa: E402
+
+
+CASES = ('hit', 'miss', 'transition')
+# The filesystem calls we count, by where they live
+COUNTED_CALLS = (
+    (os, 'stat'),
+    (os, 'lstat'),
+    (os, 'readlink'),
+    (os, 'scandir'),
+    (os, 'listdir'),
+    (os, 'mkdir'),
+    (os, 'replace'),
+    (os, 'rename'),
+    (os, 'unlink'),
+    (os, 'utime'),
+    (builtins, 'open'),
+)
+
+
+@contextlib.contextmanager
+def counting_calls():
+    counts = dict.fromkeys((name for _, name in COUNTED_CALLS), 0)
+    originals = [(module, name, getattr(module, name)) for module, name in COUNTED_CALLS]
+
+    def counted(name, func):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    for module, name, func in originals:
+        setattr(module, name, counted(name, func))
+    try:
+        yield counts
+    finally:
+        for module, name, func in originals:
+            setattr(module, name, func)
+
+
+def write_config(path, lines):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as config:
+        config.write(''.join(line + '\n' for line in lines))
+
+
+def make_tree(root, depth, entries):
+    """A project at the top of a `depth`-level tree, and a home with `entries`-line configs"""
+    project = os.path.join(root, 'tree')
+    pwd = os.path.join(project, *('d%d' % level for level in range(depth)))
+    os.makedirs(pwd)
+    with open(os.path.join(project, aactivator.ACTIVATE), 'w') as activate:
+        activate.write('true\n')
+
+    home = os.path.join(root, 'home')
+    config = os.path.join(home, '.cache', 'aactivator')
+    others = [os.path.join(root, 'other%d' % i) for i in range(entries)]
+    write_config(os.path.join(config, 'allowed'), others + [project])
+    write_config(os.path.join(config, 'disallowed'), others)
+    # Under the tree's parent, so they survive refresh_not_now
+    write_config(os.path.join(config, 'not-now'), [os.path.join(root, 'later%d' % i) for i in range(entries)])
+    return home, project, pwd
+
+
+def measure(case, depth, entries, repeat, extra_environ=()):
+    root = tempfile.mkdtemp(prefix='aactivator-bench-')
+    try:
+        home, project, pwd = make_tree(os.path.realpath(root), depth, entries)
+        environ = dict(extra_environ, HOME=home, AACTIVATOR_VERSION=aactivator.__version__)
+        if case == 'hit':
+            environ[aactivator.ENVIRONMENT_VARIABLE] = project
+        elif case == 'miss':
+            os.remove(os.path.join(project, aactivator.ACTIVATE))
+
+        def get_input():
+            raise AssertionError('benchmarks should never prompt')
+
+        def run():
+            return aactivator.get_output(dict(environ), pwd, get_input, memo=True)
+
+        run()  # warm up the OS caches
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            timings.append((time.perf_counter() - start) * 1000)
+        with counting_calls() as calls:
+            run()
+    finally:
+        shutil.rmtree(root)
+
+    return {
+        'case': case,
+        'depth': depth,
+        'entries': entries,
+        'min_ms': round(min(timings), 4),
+        'median_ms': round(statistics.median(timings), 4),
+        'calls': calls,
+        'total_calls': sum(calls.values()),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ('git', 'rev-parse', 'HEAD'),
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(depths, sizes, cases, repeat, extra_environ=()):
+    return {
+        'aactivator': aactivator.__version__,
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'environ': dict(extra_environ),
+        'results': [
+            measure(case, depth, entries, repeat, extra_environ)
+            for case in cases
+            for depth in depths
+            for entries in sizes
+        ],
+    }
+
+
+def compare(before, after):
+    """One line per benchmark present in both runs, with the change in median time and calls"""
+    def key(result):
+        return (result['case'], result['depth'], result['entries'])
+
+    old = {key(result): result for result in before['results']}
+    lines = ['{:<12}{:>7}{:>9}{:>12}{:>12}{:>9}{:>8}'.format(
+        'case', 'depth', 'entries', 'before ms', 'after ms', 'ratio', 'calls',
+    )]
+    for result in after['results']:
+        if key(result) not in old:
+            continue
+        previous = old[key(result)]
+        lines.append('{:<12}{:>7}{:>9}{:>12.3f}{:>12.3f}{:>9.2f}{:>+8d}'.format(
+            result['case'], result['depth'], result['entries'],
+            previous['median_ms'], result['median_ms'],
+            result['median_ms'] / previous['median_ms'] if previous['median_ms'] else float('inf'),
+            result['total_calls'] - previous['total_calls'],
+        ))
+    return '\n'.join(lines)
+
+
+def integers(value):
+    return [int(part) for part in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--depths', type=integers, default=[5, 15, 30, 60])
+    parser.add_argument('--sizes', type=integers, default=[10, 1000, 100000])
+    parser.add_argument('--cases', type=lambda value: value.split(','), default=list(CASES))
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument(
+        '--env', action='append', default=[], type=lambda value: tuple(value.split('=', 1)),
+        metavar='NAME=VALUE', help='extra environment for aactivator, e.g. --env AACTIVATOR_INDEX=1',
+    )
+    parser.add_argument('--output', help='write JSON results here (default: stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two JSON results')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        before, after = (json.load(open(path)) for path in args.compare)
+        print(compare(before, after))
+        return
+
+    results = json.dumps(run(args.depths, args.sizes, args.cases, args.repeat, args.env), indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(results + '\n')
+    else:
+        print(results)
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import os.path
+import subprocess
+import sys
+
+
+BENCH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'bench', 'latency.py')
+
+
+def bench(*args):
+    return subprocess.check_output((sys.executable, BENCH) + args).decode()
+
+
+def test_benchmark_results(tmpdir):
+    output = tmpdir.join('results.json')
+    bench('--depths', '2,3', '--sizes', '1', '--repeat', '1', '--output', str(output))
+    results = json.loads(output.read())
+
+    assert [
+        (result['case'], result['depth'], result['entries'])
+        for result in results['results']
+    ] == [
+        ('hit', 2, 1), ('hit', 3, 1),
+        ('miss', 2, 1), ('miss', 3, 1),
+        ('transition', 2, 1), ('transition', 3, 1),
+    ]
+    for result in results['results']:
+        assert result['calls']['stat'] > 0
+        assert result['total_calls'] == sum(result['calls'].values())
+    # a deeper tree can only take more probing
+    assert results['results'][1]['total_calls'] > results['results'][0]['total_calls']
+
+
+def test_benchmark_compare(tmpdir):
+    output = tmpdir.join('results.json')
+    bench('--depths', '2', '--sizes', '1', '--cases', 'miss', '--repeat', '1', '--output', str(output))
+    comparison = bench('--compare', str(output), str(output)).splitlines()
+    assert comparison[0].split() == ['case', 'depth', 'entries', 'before', 'ms', 'after', 'ms', 'ratio', 'calls']
+    assert comparison[1].split()[:3] == ['miss', '2', '1']
+    assert comparison[1].split()[-2:] == ['1.00', '+0']
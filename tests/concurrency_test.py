@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import fcntl
+import json
+import subprocess
+import sys
+
+import aactivator
+
+
+WORKERS = 16
+ROUNDS = 8
+
+# Answers "n" then "y" for a project of its own each round, while every other
+# worker expires not-now answers and appends to the same files.
+WORKER = '''\
+import json, sys, time
+import aactivator
+home, worker, rounds = sys.argv[1], sys.argv[2], int(sys.argv[3])
+env = {'HOME': home, 'AACTIVATOR_VERSION': aactivator.__version__}
+timings = []
+for i in range(rounds):
+    for answer in 'ny':
+        start = time.perf_counter()
+        aactivator.get_output(env, '{0}/{1}_{2}_{3}'.format(home, answer, worker, i), lambda: answer)
+        timings.append(time.perf_counter() - start)
+print(json.dumps(timings))
+'''
+
+
+def test_concurrent_shells_lose_nothing(tmpdir):
+    for answer in 'ny':
+        for worker in range(WORKERS):
+            for i in range(ROUNDS):
+                tmpdir.join('{0}_{1}_{2}'.format(answer, worker, i), '.activate.sh').ensure()
+    config = tmpdir.join('.cache/aactivator')
+    # Each of these expires as soon as anyone looks
+    config.join('not-now').write(''.join('/elsewhere/{0}\n'.format(i) for i in range(100)), ensure=True)
+
+    workers = [
+        subprocess.Popen(
+            (sys.executable, '-c', WORKER, str(tmpdir), str(worker), str(ROUNDS)),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        )
+        for worker in range(WORKERS)
+    ]
+    timings = sorted(
+        timing
+        for worker in workers
+        for timing in json.loads(worker.communicate()[0].decode())
+    )
+    assert [worker.returncode for worker in workers] == [0] * WORKERS
+
+    for answer, name in (('n', 'not-now'), ('y', 'allowed')):
+        lines = config.join(name).read().splitlines()
+        assert sorted(lines) == sorted(
+            str(tmpdir.join('{0}_{1}_{2}'.format(answer, worker, i)))
+            for worker in range(WORKERS)
+            for i in range(ROUNDS)
+        )
+    assert not config.join('disallowed').check()
+
+    # Waiting on each other's locks stays well short of anything noticeable
+    assert len(timings) == WORKERS * ROUNDS * 2
+    assert timings[len(timings) * 99 // 100] < 1
+
+
+def test_lock_is_exclusive(tmpdir):
+    holder = subprocess.Popen(
+        (
+            sys.executable, '-c',
+            'import sys, aactivator\n'
+            'with aactivator.ConfigLock(sys.argv[1]):\n'
+            '    print("locked", flush=True)\n'
+            '    sys.stdin.read()\n',
+            str(tmpdir),
+        ),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+    )
+    try:
+        assert holder.stdout.readline() == b'locked\n'
+        with open(str(tmpdir.join('lock')), 'r+') as lock:
+            try:
+                fcntl.lockf(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except OSError:
+                pass
+            else:  # pragma: no cover
+                raise AssertionError('not locked')
+    finally:
+        holder.stdin.close()
+        holder.wait()
+    with aactivator.ConfigLock(str(tmpdir), exclusive=False):
+        pass
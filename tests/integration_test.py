@@ -277,14 +277,83 @@ TEST> echo
     run_test(shell, test, tmpdir)
 
 
-def test_activate_but_no_deactivate(venv_path, tmpdir, deactivate, shell):
+def test_activate_but_no_deactivate(venv_path, tmpdir, activate, deactivate, shell):
     make_venv_in_tempdir(tmpdir)
     deactivate.remove()
+    activate.write('export PATH=/venv:"$PATH" PROJECT_TEST=1\n', mode='a')
 
     test = '''\
 TEST> eval "$(aactivator init)"
 TEST> echo
 
+TEST> export PATH=/bin:"$PATH"
+TEST> cd {venv_path}
+aactivator will source .activate.sh and .deactivate.sh at {venv_path}.
+Acceptable? (y)es (n)o (N)ever: INPUT> y
+aactivator will remember this: ~/.cache/aactivator/allowed
+aactivating...
+TEST> echo "$PATH" | cut -d: -f1-2
+(aliased) /venv:/bin
+TEST> cd /
+TEST> echo "$PATH" | cut -d: -f1
+(aliased) /bin
+TEST> echo "${{PROJECT_TEST-unset}}"
+(aliased) unset
+'''
+    test = test.format(venv_path=str(venv_path))
+    run_test(shell, test, tmpdir)
+
+
+def test_declare_in_activate_sh_is_global(venv_path, tmpdir, activate, shell):
+    if 'zsh' in shell['cmd'][0]:
+        pytest.skip("zsh's precmd hooks are functions, where typeset is always local")
+    make_venv_in_tempdir(tmpdir)
+    activate.write('declare -x FOO=bar\ndeclare -a ARR=(1 2)\n', mode='a')
+
+    test = '''\
+TEST> eval "$(aactivator init)"
+TEST> echo
+
+TEST> cd {venv_path}
+aactivator will source .activate.sh and .deactivate.sh at {venv_path}.
+Acceptable? (y)es (n)o (N)ever: INPUT> y
+aactivator will remember this: ~/.cache/aactivator/allowed
+aactivating...
+TEST> echo "$FOO ${{ARR[1]}}"
+(aliased) bar 2
+'''
+    test = test.format(venv_path=str(venv_path))
+    run_test(shell, test, tmpdir)
+
+
+def test_interrupted_activate_sh(venv_path, tmpdir, activate, shell):
+    make_venv_in_tempdir(tmpdir)
+    activate.write('if [ -e ~/slow ]; then rm ~/slow; echo sleeping; sleep 10; fi\n' + activate.read())
+    tmpdir.join('slow').write('')
+
+    proc = get_proc(shell['cmd'], tmpdir)
+    run_cmd(proc, 'eval "$(aactivator init)"')
+    run_cmd(
+        proc, 'cd {venv_path}'.format(venv_path=venv_path),
+        'aactivator will source .activate.sh and .deactivate.sh at {venv_path}.\n'
+        'Acceptable? (y)es (n)o (N)ever: '.format(venv_path=venv_path),
+    )
+    run_input(proc, 'y', 'aactivator will remember this: ~/.cache/aactivator/allowed\nsleeping\n')
+    proc.sendintr()
+    # Whether the shell tries again straight away is up to it
+    proc.expect_exact(PS1)
+    proc.sendline('cd /')
+    proc.expect_exact(PS1)
+    # But aactivator keeps working after
+    run_input(proc, 'cd {venv_path}'.format(venv_path=venv_path), 'aactivating...\n')
+    run_cmd(proc, 'echo "[$_aactivator_busy]"', '(aliased) []\n')
+
+
+def test_notices_activate_sh_changes_in_place(venv_path, tmpdir, shell):
+    make_venv_in_tempdir(tmpdir)
+
+    test = '''\
+TEST> eval "$(aactivator init)"
 TEST> cd {venv_path}
 aactivator will source .activate.sh and .deactivate.sh at {venv_path}.
 Acceptable? (y)es (n)o (N)ever: INPUT> y
@@ -292,15 +361,16 @@ aactivator will remember this: ~/.cache/aactivator/allowed
 aactivating...
 TEST> echo
 (aliased)
-TEST> cd /
-(aliased) aactivator: Cannot deactivate. File missing: {deactivate}
+TEST> mv .activate.sh activate.bak
+(aliased) deactivating...
+TEST> echo
+
+TEST> mv activate.bak .activate.sh
+aactivating...
 TEST> echo
 (aliased)
 '''
-    test = test.format(
-        venv_path=str(venv_path),
-        deactivate=str(deactivate),
-    )
+    test = test.format(venv_path=str(venv_path))
     run_test(shell, test, tmpdir)
 
 
@@ -441,3 +511,128 @@ TEST> echo
 '''
     test = test.format(venv_path=str(venv_path), exe=exe)
     run_test(shell, test, tmpdir)
+
+
+def test_fast_mode_runs_python_only_when_needed(venv_path, shell, tmpdir):
+    make_venv_in_tempdir(tmpdir)
+    # Which has a line for every time the hook ran python (and for each .activate.sh sourced)
+    profile = tmpdir.join('profile').strpath
+
+    test = '''\
+TEST> export AACTIVATOR_PROFILE={profile}
+TEST> eval "$(aactivator init --mode=fast)"
+TEST> echo
+
+TEST> cd {venv_path}
+aactivator will source .activate.sh and .deactivate.sh at {venv_path}.
+Acceptable? (y)es (n)o (N)ever: INPUT> y
+aactivator will remember this: ~/.cache/aactivator/allowed
+aactivating...
+TEST> grep -vc '"script"' {profile}
+2
+TEST> cd child-dir
+TEST> grep -vc '"script"' {profile}
+2
+TEST> cd /
+(aliased) deactivating...
+TEST> grep -vc '"script"' {profile}
+3
+'''
+    test = test.format(venv_path=str(venv_path), profile=profile)
+    run_test(shell, test, tmpdir)
+
+
+def test_chpwd_trigger(venv_path, shell, tmpdir):
+    make_venv_in_tempdir(tmpdir)
+    profile = tmpdir.join('profile').strpath
+
+    test = '''\
+TEST> export AACTIVATOR_PROFILE={profile}
+TEST> eval "$(aactivator init --trigger=chpwd)"
+TEST> echo
+
+TEST> cd {venv_path}
+aactivator will source .activate.sh and .deactivate.sh at {venv_path}.
+Acceptable? (y)es (n)o (N)ever: INPUT> y
+aactivator will remember this: ~/.cache/aactivator/allowed
+aactivating...
+TEST> grep -vc '"script"' {profile}
+2
+TEST> cd child-dir
+TEST> grep -vc '"script"' {profile}
+3
+TEST> unset _aactivator_memo
+TEST> grep -vc '"script"' {profile}
+3
+TEST> AACTIVATOR_INTERVAL=0 && unset _aactivator_memo
+TEST> grep -vc '"script"' {profile}
+4
+'''
+    test = test.format(venv_path=str(venv_path), profile=profile)
+    run_test(shell, test, tmpdir)
+
+
+def test_env_cache_replays_activate_sh(venv_path, activate, deactivate, shell, tmpdir):
+    make_venv_in_tempdir(tmpdir)
+    activate.write('export PATH=/venv:"$PATH"\n', mode='a')
+    deactivate.write('export PATH="${PATH#/venv:}"\n', mode='a')
+
+    test = '''\
+TEST> export AACTIVATOR_ENV_CACHE=1
+TEST> eval "$(aactivator init)"
+TEST> echo
+
+TEST> cd {venv_path}
+aactivator will source .activate.sh and .deactivate.sh at {venv_path}.
+Acceptable? (y)es (n)o (N)ever: INPUT> y
+aactivator will remember this: ~/.cache/aactivator/allowed
+aactivating...
+TEST> cd /
+(aliased) deactivating...
+TEST> PATH=/bin:"$PATH"
+TEST> cd {venv_path}
+TEST> echo
+(aliased)
+TEST> echo "$PATH" | cut -d: -f1-2
+(aliased) /venv:/bin
+'''
+    test = test.format(venv_path=str(venv_path))
+    run_test(shell, test, tmpdir)
+
+
+def test_nested_activation(venv_path, shell, tmpdir):
+    make_venv_in_tempdir(tmpdir)
+    for name in ('inner', 'sibling'):
+        project = make_venv_in_tempdir(venv_path, name)
+        project.join('.activate.sh').write('echo entering {0}\n'.format(name))
+        project.join('.deactivate.sh').write('echo leaving {0}\n'.format(name))
+
+    test = '''\
+TEST> export AACTIVATOR_NESTED=1
+TEST> eval "$(aactivator init)"
+TEST> echo
+
+TEST> cd {venv_path}/inner
+aactivator will source .activate.sh and .deactivate.sh at {venv_path}/inner.
+Acceptable? (y)es (n)o (N)ever: INPUT> y
+aactivator will remember this: ~/.cache/aactivator/allowed
+aactivator will source .activate.sh and .deactivate.sh at {venv_path}.
+Acceptable? (y)es (n)o (N)ever: INPUT> y
+aactivator will remember this: ~/.cache/aactivator/allowed
+aactivating...
+(aliased) entering inner
+TEST> cd ../sibling
+aactivator will source .activate.sh and .deactivate.sh at {venv_path}/sibling.
+Acceptable? (y)es (n)o (N)ever: INPUT> y
+aactivator will remember this: ~/.cache/aactivator/allowed
+(aliased) leaving inner
+(aliased) entering sibling
+TEST> cd ..
+(aliased) leaving sibling
+TEST> echo
+(aliased)
+TEST> cd /
+(aliased) deactivating...
+'''
+    test = test.format(venv_path=str(venv_path))
+    run_test(shell, test, tmpdir)
@@ -4,7 +4,17 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import functools
+import io
+import json
+import os.path
+import shlex
+import socket
+import stat
+import subprocess
 import sys
+import threading
+import time
+from unittest import mock
 
 import pytest
 
@@ -40,6 +50,18 @@ def active_env(venv_path, inactive_env):
     return inactive_env + (('AACTIVATOR_ACTIVE', str(venv_path)),)
 
 
+def activates(path, source='source ./.activate.sh'):
+    return '{{ _aactivator_enter {0} && {1}; _aactivator_leave; }} &&\nexport AACTIVATOR_ACTIVE={0}'.format(
+        path, source,
+    )
+
+
+def deactivates(path):
+    return '{{ _aactivator_enter {0} && source ./.deactivate.sh; _aactivator_leave; unset AACTIVATOR_ACTIVE; }}'.format(
+        path,
+    )
+
+
 def test_is_safe_to_source_fine(f_path):
     f_path.open('a').close()
     assert aactivator.insecure(str(f_path)) is None
@@ -111,15 +133,7 @@ def test_get_output_sourced_not_in_directory(tmpdir, venv_path, active_env):
     )
     assert (
         output ==
-        '''\
-OLDPWD_bak="$OLDPWD" &&
-cd {venv_path} &&
-aactivator security-check .deactivate.sh &&
-source ./.deactivate.sh
-unset AACTIVATOR_ACTIVE &&
-cd "$OLDPWD_bak" &&
-cd {tmpdir} &&
-unset OLDPWD_bak'''.format(venv_path=str(venv_path), tmpdir=str(tmpdir))
+        deactivates(venv_path)
     )
 
 
@@ -146,18 +160,7 @@ def test_get_output_sourced_deeper_venv(tmpdir, venv_path, active_env):
     )
     assert (
         output ==
-        '''\
-OLDPWD_bak="$OLDPWD" &&
-cd {venv_path} &&
-aactivator security-check .deactivate.sh &&
-source ./.deactivate.sh
-unset AACTIVATOR_ACTIVE &&
-cd "$OLDPWD_bak" &&
-cd {venv_path}/deeper &&
-unset OLDPWD_bak &&
-aactivator security-check .activate.sh &&
-source ./.activate.sh &&
-export AACTIVATOR_ACTIVE={venv_path}/deeper'''.format(venv_path=str(venv_path))
+        deactivates(venv_path) + ' &&\n' + activates(venv_path.join('deeper'))
     )
 
 
@@ -170,10 +173,7 @@ def test_not_sourced_sources(tmpdir, venv_path, inactive_env):
     )
     assert (
         output ==
-        '''\
-aactivator security-check .activate.sh &&
-source ./.activate.sh &&
-export AACTIVATOR_ACTIVE=''' + str(venv_path)
+        activates(venv_path)
     )
 
 
@@ -187,18 +187,7 @@ def test_get_output_change_venv(tmpdir, venv_path, active_env):
     )
     assert (
         output ==
-        '''\
-OLDPWD_bak="$OLDPWD" &&
-cd {venv_path} &&
-aactivator security-check .deactivate.sh &&
-source ./.deactivate.sh
-unset AACTIVATOR_ACTIVE &&
-cd "$OLDPWD_bak" &&
-cd {venv_path}2 &&
-unset OLDPWD_bak &&
-aactivator security-check .activate.sh &&
-source ./.activate.sh &&
-export AACTIVATOR_ACTIVE={venv_path}2'''.format(venv_path=str(venv_path))
+        deactivates(venv_path) + ' &&\n' + activates(str(venv_path) + '2')
     )
 
 
@@ -306,3 +295,1316 @@ def test_no_is_remembered_until_cd_out(venv_path, tmpdir, no_config, yes_config)
     # cd to a parent directory directory (and back) should
     assert yes_config().find_allowed('/') is None
     assert yes_config().find_allowed(str(child_dir)) == str(venv_path)
+
+
+@pytest.mark.parametrize('s', ('', 'simple/path-1.0', "it's", 'a b', '$HOME', 'ü'))
+def test_quote_matches_shlex(s):
+    assert aactivator.quote(s) == shlex.quote(s)
+
+
+def test_user_cache_dir():
+    assert aactivator.user_cache_dir({'HOME': '/home/me'}) == '/home/me/.cache'
+    assert aactivator.user_cache_dir({'HOME': '/', 'XDG_CACHE_HOME': '~/c'}) == '/c'
+    assert aactivator.user_cache_dir({'HOME': '/h', 'XDG_CACHE_HOME': '/c'}) == '/c'
+
+
+# Modules the "nothing to do" prompt can import, and how long importing aactivator may take
+NOOP_MODULE_BUDGET = 10
+NOOP_IMPORT_BUDGET_US = 100000
+
+
+def test_noop_prompt_startup_budget(tmpdir, inactive_env):
+    script = '''\
+import json, sys
+before = set(sys.modules)
+sys.path.insert(0, {root!r})
+import aactivator
+assert aactivator.get_output({env!r}, {pwd!r}, memo=True).startswith('_aactivator_watch=')
+print(json.dumps(sorted(set(sys.modules) - before - {{'json'}})))
+'''.format(
+        root=os.path.dirname(aactivator.__file__), env=dict(inactive_env), pwd=str(tmpdir),
+    )
+    proc = subprocess.run(
+        (sys.executable, '-S', '-X', 'importtime', '-c', script),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+    )
+    modules = json.loads(proc.stdout.decode())
+    assert 'aactivator' in modules
+    assert not {'re', 'shlex', 'socket', 'threading'} & set(modules)
+    assert len(modules) <= NOOP_MODULE_BUDGET, modules
+
+    import_times = {
+        line.split('|')[2].strip(): int(line.split('|')[1])
+        for line in proc.stderr.decode().splitlines()
+        if line.startswith('import time:') and line.count('|') == 2 and 'cumulative' not in line
+    }
+    assert import_times['aactivator'] < NOOP_IMPORT_BUDGET_US
+
+
+def test_get_output_memo(tmpdir, venv_path, inactive_env):
+    make_venv_in_tempdir(tmpdir)
+    deeper = venv_path.join('child-dir')
+    output = aactivator.get_output(
+        dict(inactive_env),
+        str(deeper),
+        lambda: 'y',
+        memo=True,
+    )
+    cache = tmpdir.join('.cache/aactivator')
+    assert output.endswith(
+        activates(venv_path) + ''' &&
+_aactivator_watch=({cache} {cache}/allowed {cache}/not-now {cache}/disallowed {deeper} {venv_path} {venv_path}/.activate.sh) &&
+_aactivator_stamp={cache}/stamps/$$ &&
+_aactivator_memo="$PWD:$AACTIVATOR_VERSION:$AACTIVATOR_ACTIVE"'''.format(
+            cache=str(cache), deeper=str(deeper), venv_path=str(venv_path),
+        )
+    )
+    assert cache.join('stamps').check(dir=1)
+
+
+def test_get_output_memo_nothing_found(tmpdir, inactive_env):
+    output = aactivator.get_output(dict(inactive_env), str(tmpdir), memo=True)
+    watched = output.splitlines()[0]
+    assert watched.startswith('_aactivator_watch=(')
+    # every directory up to the filesystem boundary is watched for a new .activate.sh
+    for path in aactivator.search_parent_paths(str(tmpdir)):
+        assert ' ' + path + ' ' in watched or watched.endswith(' ' + path + ') &&')
+
+
+@pytest.fixture
+def server(tmpdir):
+    return aactivator.Server(str(tmpdir.join('aactivator.sock')))
+
+
+def test_server_matches_get_output(tmpdir, venv_path, inactive_env, allowed_config, server):
+    make_venv_in_tempdir(tmpdir)
+    allowed_config.write(str(venv_path) + '\n', ensure=True)
+    expected = aactivator.get_output(dict(inactive_env), str(venv_path), memo=True)
+    assert server.get_output(dict(inactive_env), str(venv_path), '/path/to/aactivator') == expected
+
+
+def test_server_reuses_answer_until_watched_path_changes(
+        tmpdir, venv_path, activate, active_env, allowed_config, server, monkeypatch,
+):
+    make_venv_in_tempdir(tmpdir)
+    allowed_config.write(str(venv_path) + '\n', ensure=True)
+    first = server.get_output(dict(active_env), str(venv_path), '/path/to/aactivator')
+    assert first.startswith('_aactivator_watch=')
+
+    real_get_output = aactivator.get_output
+    calls = []
+    monkeypatch.setattr(
+        aactivator, 'get_output', lambda *args, **kwargs: calls.append(1) or real_get_output(*args, **kwargs),
+    )
+    assert server.get_output(dict(active_env), str(venv_path), '/path/to/aactivator') == first
+    assert calls == []
+
+    activate.write('# changed\n', mode='a')
+    assert server.get_output(dict(active_env), str(venv_path), '/path/to/aactivator') == first
+    assert calls == [1]
+
+
+def test_server_checks_activate_sh_every_time(tmpdir, venv_path, inactive_env, allowed_config, server):
+    make_venv_in_tempdir(tmpdir)
+    allowed_config.write(str(venv_path) + '\n', ensure=True)
+    output = server.get_output(dict(inactive_env), str(venv_path), '/path/to/aactivator')
+    assert activates(venv_path) in output
+
+    tmpdir.chmod(0o777)
+    try:
+        output = server.get_output(dict(inactive_env), str(venv_path), '/path/to/aactivator')
+    finally:
+        tmpdir.chmod(0o755)
+    assert 'Cowardly refusing' in output
+    assert 'export AACTIVATOR_ACTIVE' not in output
+
+
+def test_server_checks_deactivate_sh_every_time(tmpdir, venv_path, deactivate, active_env, server):
+    make_venv_in_tempdir(tmpdir)
+    output = server.get_output(dict(active_env), str(tmpdir), '/path/to/aactivator')
+    assert deactivates(venv_path) in output
+
+    deactivate.chmod(0o666)
+    output = server.get_output(dict(active_env), str(tmpdir), '/path/to/aactivator')
+    assert 'Cowardly refusing' in output
+    assert 'source ./.deactivate.sh' not in output
+
+
+def test_server_reuses_parsed_config_files(tmpdir, allowed_config, server):
+    allowed_config.write('/a\n', ensure=True)
+    directory = allowed_config.dirname
+    config_file = server.config_file(directory, 'allowed')
+    assert server.config_file(directory, 'allowed') is config_file
+
+    allowed_config.write('/a\n/b\n')
+    assert server.config_file(directory, 'allowed').lines == frozenset(('/a', '/b'))
+
+
+def test_server_leaves_prompts_to_the_terminal(tmpdir, venv_path, inactive_env, allowed_config, server):
+    make_venv_in_tempdir(tmpdir)
+    assert server.get_output(dict(inactive_env), str(venv_path), '/path/to/aactivator') == ''
+    assert allowed_config.check(exists=0)
+
+
+def test_server_handle(tmpdir, inactive_env, server):
+    client, conn = socket.socketpair()
+    request = [str(tmpdir), '/path/to/aactivator', 'XDG_CACHE_HOME=']
+    request += ['{}={}'.format(name, value) for name, value in inactive_env]
+    client.sendall('\0'.join(request).encode())
+    client.shutdown(socket.SHUT_WR)
+    server.handle(conn)
+    conn.close()
+    assert client.recv(65536).decode() == aactivator.get_output(
+        dict(inactive_env), str(tmpdir), memo=True,
+    )
+
+
+def test_serve_refuses_to_run_twice(tmpdir, server):
+    listening = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listening.bind(server.path)
+    listening.listen(1)
+    try:
+        assert server.serve_forever() == 'aactivator: Already serving on ' + server.path
+    finally:
+        listening.close()
+
+
+def test_serve_needs_runtime_dir():
+    assert aactivator.serve({}) == 'aactivator: XDG_RUNTIME_DIR must be set to serve'
+
+
+@pytest.fixture
+def not_now_config(tmpdir):
+    return tmpdir.join('.cache/aactivator/not-now')
+
+
+def test_not_now_untouched_in_steady_state(tmpdir, venv_path, no_config, not_now_config, monkeypatch):
+    make_venv_in_tempdir(tmpdir)
+    assert no_config().find_allowed(str(venv_path)) is None
+    before = not_now_config.stat()
+
+    writes = []
+    monkeypatch.setattr(aactivator.ConfigFile, '_append', lambda *args: writes.append(args))
+    monkeypatch.setattr(aactivator.ConfigFile, '_replace', lambda *args: writes.append(args))
+    for path in (venv_path, venv_path.join('child-dir'), tmpdir):
+        assert no_config().find_allowed(str(path)) is None
+    assert writes == []
+    after = not_now_config.stat()
+    assert (after.ino, after.mtime) == (before.ino, before.mtime)
+
+
+def test_not_now_expiry_replaces_file(tmpdir, venv_path, no_config, not_now_config):
+    make_venv_in_tempdir(tmpdir)
+    other = str(tmpdir.join('other'))
+    assert no_config().find_allowed(str(venv_path)) is None
+    not_now_config.write(other + '\n', mode='a')
+    before = not_now_config.stat()
+
+    # leaving tmpdir expires both answers
+    assert no_config().find_allowed('/') is None
+    assert not_now_config.read() == ''
+    assert not_now_config.stat().ino != before.ino
+    # and leaves no temporary file behind
+    assert sorted(not_now_config.dirpath().listdir()) == [not_now_config.dirpath().join('lock'), not_now_config]
+
+
+def test_not_now_partial_expiry(tmpdir, venv_path, not_now_config, yes_config):
+    kept = str(tmpdir.join('kept'))
+    expired = '/elsewhere/project'
+    not_now_config.write(expired + '\n' + kept + '\n', ensure=True)
+    assert yes_config().find_allowed(str(tmpdir)) is None
+    assert not_now_config.read() == kept + '\n'
+
+
+@pytest.fixture
+def indexed(allowed_config):
+    allowed_config.write('/b\n/a\n/c\n/a\n', ensure=True)
+    return aactivator.IndexedConfigFile(allowed_config.dirname, 'allowed')
+
+
+def test_indexed_config_file_lookup(indexed, allowed_config):
+    assert [path in indexed for path in ('/a', '/b', '/c', '/', '/aa', '/d', '')] == [
+        True, True, True, False, False, False, False,
+    ]
+    assert allowed_config.new(basename='allowed.idx').check(file=1)
+
+
+def test_indexed_config_file_missing(tmpdir):
+    indexed = aactivator.IndexedConfigFile(str(tmpdir), 'allowed')
+    assert '/a' not in indexed
+    assert tmpdir.listdir() == []
+
+
+def test_indexed_config_file_reused_without_parsing(indexed, allowed_config, monkeypatch):
+    assert '/a' in indexed
+    monkeypatch.setattr(aactivator, '_get_lines_if_there', lambda path: pytest.fail('parsed ' + path))
+    reopened = aactivator.IndexedConfigFile(allowed_config.dirname, 'allowed')
+    assert '/b' in reopened
+    assert '/bb' not in reopened
+
+
+@pytest.mark.parametrize('new', ('/0', '/a', '/bb', '/z'))
+def test_indexed_config_file_append_splices(indexed, allowed_config, monkeypatch, new):
+    assert '/a' in indexed
+    monkeypatch.setattr(aactivator, '_get_lines_if_there', lambda path: pytest.fail('parsed ' + path))
+    indexed.append(new)
+    assert allowed_config.read().endswith(new + '\n')
+
+    reopened = aactivator.IndexedConfigFile(allowed_config.dirname, 'allowed')
+    for path in ('/a', '/b', '/c', new):
+        assert path in reopened
+    assert '/y' not in reopened
+    assert reopened._count(reopened.index) == len({'/a', '/b', '/c', new})
+
+
+def test_indexed_config_file_rebuilt_after_outside_change(indexed, allowed_config):
+    assert '/d' not in indexed
+    allowed_config.write('/d\n', mode='a')
+    assert '/d' in aactivator.IndexedConfigFile(allowed_config.dirname, 'allowed')
+
+
+def test_indexed_config_is_remembered(tmpdir, venv_path, inactive_env, allowed_config):
+    make_venv_in_tempdir(tmpdir)
+    env = dict(inactive_env, AACTIVATOR_INDEX='1')
+    config = aactivator.ActivateConfig(env, lambda: 'y')
+    assert isinstance(config.allowed, aactivator.IndexedConfigFile)
+    assert isinstance(config.not_now, aactivator.ConfigFile)
+    assert config.find_allowed(str(venv_path)) == str(venv_path)
+
+    config = aactivator.ActivateConfig(env, lambda: pytest.fail('prompted'))
+    assert config.find_allowed(str(venv_path)) == str(venv_path)
+    assert allowed_config.new(basename='allowed.idx').check(file=1)
+
+
+def test_stat_cache(tmpdir):
+    stats = aactivator.StatCache()
+    assert stats.stat(str(tmpdir)).st_ino == tmpdir.stat().ino
+    assert stats.stat(str(tmpdir)).st_ino == tmpdir.stat().ino
+    assert stats.stat(str(tmpdir.join('missing'))) is None
+    assert stats.stat(str(tmpdir.join('missing/deeper'))) is None
+    assert stats.calls == 3
+
+    # lstat of anything but a symlink answers stat too
+    f = tmpdir.join('f').ensure()
+    assert stats.lstat(str(f)).st_ino == stats.stat(str(f)).st_ino
+    assert stats.calls == 4
+
+
+def test_stat_cache_prefetch(tmpdir, monkeypatch):
+    paths = [str(tmpdir.join(name).ensure()) for name in 'abcdef'] + [str(tmpdir.join('missing'))]
+    in_flight, most = set(), set()
+    lock = threading.Lock()
+    real_stat = os.stat
+
+    def slow_stat(path):
+        with lock:
+            in_flight.add(path)
+            most.add(len(in_flight))
+        time.sleep(0.05)
+        with lock:
+            in_flight.remove(path)
+        return real_stat(path)
+
+    monkeypatch.setattr(os, 'stat', slow_stat)
+    stats = aactivator.StatCache()
+    stats.prefetch(paths + paths[:2], workers=4)
+    assert max(most) == 4
+    assert stats.calls == len(paths)
+
+    # Answered from what was gathered
+    monkeypatch.undo()
+    assert stats.stat(paths[0]).st_ino == tmpdir.join('a').stat().ino
+    assert stats.stat(paths[-1]) is None
+    stats.prefetch(paths)
+    assert stats.calls == len(paths)
+
+    # lstat of a directory says what stat would, but not of a symlink
+    link = tmpdir.join('link')
+    link.mksymlinkto('a')
+    stats.prefetch([], lstat=[str(tmpdir), str(link)])
+    assert stats.calls == len(paths) + 2
+    assert stats.stat(str(tmpdir)) == os.stat(str(tmpdir))
+    assert stats.calls == len(paths) + 2
+    assert stat.S_ISLNK(stats.lstat(str(link)).st_mode)
+    assert stats.stat(str(link)).st_ino == tmpdir.join('a').stat().ino
+    assert stats.calls == len(paths) + 3
+
+
+def test_stat_cache_prefetch_with_timeout(tmpdir, hung_path):
+    stats = aactivator.StatCache(timeout=0.05)
+    stats.prefetch([str(tmpdir), str(hung_path)])
+    assert stats.stat(str(tmpdir)) == os.stat(str(tmpdir))
+    with pytest.raises(aactivator.SlowFilesystem):
+        stats.stat(str(hung_path))
+
+
+def test_prefetch_keeps_first_match(tmpdir, venv_path, inactive_env, allowed_config):
+    make_venv_in_tempdir(tmpdir)
+    allowed_config.write(str(venv_path) + '\n', ensure=True)
+    deeper = venv_path.join('child-dir')
+    prefetch_env = dict(inactive_env, AACTIVATOR_PREFETCH='1')
+
+    config = aactivator.ActivateConfig(prefetch_env, lambda: pytest.fail('prompted'))
+    assert config.find_allowed(str(deeper)) == str(venv_path)
+    # Every ancestor was looked at up front, past the one which matched
+    assert os.path.join(str(tmpdir), '.activate.sh') in config.stats._stat
+
+    assert aactivator.get_output(prefetch_env, str(deeper)) == aactivator.get_output(
+        dict(inactive_env), str(deeper),
+    )
+
+
+def test_prefetch_resolves_pwd_at_once(tmpdir, venv_path, inactive_env, allowed_config, monkeypatch):
+    make_venv_in_tempdir(tmpdir)
+    allowed_config.write(str(venv_path) + '\n', ensure=True)
+    deep = venv_path.join(*'abcdefgh').ensure(dir=True)
+    sequential = []
+
+    def watched(func):
+        def wrapper(path, *args, **kwargs):
+            if threading.current_thread() is threading.main_thread() and str(path).startswith(str(venv_path)):
+                sequential.append(str(path))
+            return func(path, *args, **kwargs)
+        return wrapper
+
+    monkeypatch.setattr(os, 'stat', watched(os.stat))
+    monkeypatch.setattr(os, 'lstat', watched(os.lstat))
+    output = aactivator.get_output(dict(inactive_env, AACTIVATOR_PREFETCH='1'), str(deep))
+    monkeypatch.undo()
+    assert output == activates(venv_path)
+    # Nothing is looked at one after another but, once found, the project's .deactivate.sh
+    assert sequential == [str(venv_path.join('.deactivate.sh'))]
+
+
+def test_stat_cache_realpath(tmpdir):
+    tmpdir.mkdir('a').mkdir('b')
+    tmpdir.join('link').mksymlinkto('a/b')
+    tmpdir.join('a/up').mksymlinkto('../a/b/..')
+    tmpdir.join('loop1').mksymlinkto('loop2')
+    tmpdir.join('loop2').mksymlinkto('loop1')
+    for path in (
+            'a/b', 'link', 'link/..', 'a/up', 'a/up/b/../b', 'loop1', 'loop1/x', 'missing/../a', '.', '/',
+    ):
+        path = str(tmpdir.join(path)) if path != '/' else path
+        assert aactivator.StatCache().realpath(path) == os.path.realpath(path)
+
+
+def test_get_output_stats_each_path_once(tmpdir, venv_path, active_env, allowed_config):
+    make_venv_in_tempdir(tmpdir)
+    allowed_config.write(str(venv_path) + '\n', ensure=True)
+    deeper = venv_path.join('child-dir')
+    stats = aactivator.StatCache()
+    output = aactivator.get_output(dict(active_env), str(deeper), memo=True, stats=stats)
+    assert output.startswith('_aactivator_watch=(')
+
+    # lstat each component of $PWD, then only the .activate.sh candidates and stamps directory
+    components = len(str(deeper).split('/')) - 1
+    assert stats.calls == components + 3
+
+    # everything else was already known
+    calls = stats.calls
+    aactivator.get_output(dict(active_env), str(deeper), memo=True, stats=stats)
+    assert stats.calls == calls
+
+
+@pytest.fixture
+def negative_env(inactive_env):
+    return dict(inactive_env, AACTIVATOR_NEGATIVE_CACHE='1')
+
+
+@pytest.fixture
+def old_tree(tmpdir):
+    """A few directories without .activate.sh, last changed a while ago"""
+    deepest = tmpdir.join('a/b/c').ensure(dir=True)
+    for path in (tmpdir.join('a'), tmpdir.join('a/b'), deepest):
+        os.utime(str(path), (0, 0))
+    return deepest
+
+
+def probed_activates(env, path):
+    config = aactivator.ActivateConfig(env, lambda: pytest.fail('prompted'))
+    assert config.find_allowed(path) is None
+    return {probed for probed in set(config.stats._stat) | set(config.stats._lstat) if probed.endswith('/.activate.sh')}
+
+
+def test_negative_cache_skips_known_directories(tmpdir, old_tree, negative_env):
+    first = probed_activates(negative_env, str(old_tree))
+    assert str(tmpdir.join('a/b/.activate.sh')) in first
+    negative = tmpdir.join('.cache/aactivator/negative').read()
+    assert ' ' + str(tmpdir.join('a/b')) + '\n' in negative
+    # $PWD itself isn't worth remembering
+    assert ' ' + str(old_tree) + '\n' not in negative
+
+    second = probed_activates(negative_env, str(old_tree))
+    assert second < first
+    assert str(old_tree.join('.activate.sh')) in second
+    assert str(tmpdir.join('a/.activate.sh')) not in second
+    assert str(tmpdir.join('a/b/.activate.sh')) not in second
+
+
+def test_negative_cache_notices_new_activate(tmpdir, venv_path, old_tree, negative_env):
+    probed_activates(negative_env, str(old_tree))
+    tmpdir.join('a/.activate.sh').write('true\n')
+    config = aactivator.ActivateConfig(negative_env, lambda: 'y')
+    assert config.find_allowed(str(old_tree)) == str(tmpdir.join('a'))
+
+
+def test_negative_cache_waits_for_dangling_symlinks(tmpdir, old_tree, negative_env):
+    tmpdir.join('a/.activate.sh').mksymlinkto('venv/bin/activate')
+    os.utime(str(tmpdir.join('a')), (0, 0))
+    probed_activates(negative_env, str(old_tree))
+    tmpdir.join('a/venv/bin/activate').write('true\n', ensure=True)
+    os.utime(str(tmpdir.join('a')), (0, 0))
+    config = aactivator.ActivateConfig(negative_env, lambda: 'y')
+    assert config.find_allowed(str(old_tree)) == str(tmpdir.join('a'))
+
+
+def test_negative_cache_ignores_fresh_directories(tmpdir, negative_env):
+    fresh = tmpdir.join('a/b/c').ensure(dir=True)
+    probed_activates(negative_env, str(fresh))
+    negative = tmpdir.join('.cache/aactivator/negative')
+    assert str(fresh.dirpath()) not in (negative.read() if negative.check() else '')
+
+
+def test_negative_cache_is_bounded(tmpdir, old_tree, negative_env, monkeypatch):
+    monkeypatch.setattr(aactivator.NegativeCache, 'size', 2)
+    negative = tmpdir.join('.cache/aactivator/negative')
+    negative.write('1 1 1 /old\n1 1 5 /newer\ngarbage\n', ensure=True)
+    probed_activates(negative_env, str(old_tree))
+    assert [line.split(' ', 3)[3] for line in negative.read().splitlines()] == [
+        str(tmpdir.join('a')), str(tmpdir.join('a/b')),
+    ]
+
+
+def test_no_negative_cache_by_default(tmpdir, old_tree, inactive_env):
+    probed_activates(dict(inactive_env), str(old_tree))
+    assert tmpdir.join('.cache/aactivator/negative').check(exists=0)
+
+
+def test_security_check_relative_to_start(tmpdir, f_path):
+    f_path.open('a').close()
+    tmpdir.chmod(0o777)
+    assert aactivator.security_check(str(f_path), start=str(tmpdir)) == (
+        'aactivator: Cowardly refusing to source f because writeable by others: .'
+    )
+    assert aactivator.security_check(str(tmpdir.join('g')), start=str(tmpdir)) == (
+        'aactivator: File does not exist: g'
+    )
+
+
+def test_get_output_refuses_insecure_activate(tmpdir, venv_path, activate, inactive_env):
+    make_venv_in_tempdir(tmpdir)
+    activate.chmod(0o666)
+    output = aactivator.get_output(dict(inactive_env), str(venv_path.join('child-dir')), lambda: 'y')
+    assert output == (
+        "echo 'aactivator: Cowardly refusing to source .activate.sh because writeable by others: .activate.sh' >&2 &&\n"
+        'false'
+    )
+
+
+def test_get_output_refuses_insecure_deactivate(tmpdir, venv_path, deactivate, active_env):
+    make_venv_in_tempdir(tmpdir)
+    venv2 = make_venv_in_tempdir(tmpdir, 'venv2')
+    deactivate.chmod(0o666)
+    output = aactivator.get_output(dict(active_env), str(venv2), lambda: 'y')
+    assert output == (
+        "echo 'aactivator: Cowardly refusing to source .deactivate.sh because writeable by others: .deactivate.sh' >&2\n"
+        'unset AACTIVATOR_ACTIVE &&\n' + activates(venv2)
+    )
+
+
+@pytest.mark.parametrize(('args', 'expected'), (
+    ((), {}),
+    (('--mode=fast',), {'mode': 'fast'}),
+    (('--mode=default',), {'mode': 'default'}),
+    (('--mode=fast', '--trigger=chpwd'), {'mode': 'fast', 'trigger': 'chpwd'}),
+    (('--mode=slow',), None),
+    (('--mode',), None),
+    (('mode=fast',), None),
+    (('--color=fast',), None),
+))
+def test_parse_options(args, expected):
+    assert aactivator.parse_options(args) == expected
+
+
+def test_init_passes_its_options_to_the_hook(tmpdir):
+    exe = str(tmpdir.join('exe'))
+    assert '_aactivator_fast' not in aactivator.init(exe).split('precmd_aactivator()')[1]
+    fast = aactivator.init(exe, mode='fast')
+    launch = aactivator.launch_command(exe)
+    assert '_aactivator_reply="`AACTIVATOR_SHELL_PID=$$ {launch} --mode=fast`"'.format(launch=launch) in fast
+    assert '! _aactivator_fresh && ! _aactivator_fast; then' in fast
+    assert aactivator.aactivator((exe, 'init', '--mode=fast'), {}) == fast
+    assert aactivator.aactivator((exe, 'init', '--mode=slow'), {}).startswith('Usage:')
+
+
+def test_launch_command(tmpdir, venv_path, inactive_env):
+    make_venv_in_tempdir(tmpdir)
+    exe = str(tmpdir.join('exe'))
+    launch = shlex.split(aactivator.launch_command(exe))
+    module_dir = os.path.dirname(os.path.realpath(aactivator.__file__))
+    assert launch[:4] == [sys.executable, '-I', '-S', '-c']
+    assert 'sys.path.append({0!r})'.format(module_dir) in launch[4]
+    assert launch[5:] == ['--arg0=' + exe]
+
+    # Nothing from the environment, not even `site`, and still at home in the hook
+    env = dict(inactive_env, PYTHONPATH=str(tmpdir.join('nowhere')))
+    proc = subprocess.run(
+        launch[:3] + ['-X', 'importtime'] + launch[3:] + ['init'],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True,
+    )
+    assert proc.stdout.decode() == aactivator.init(exe) + '\n'
+    imported = [line.split('|')[-1].strip() for line in proc.stderr.decode().splitlines()]
+    assert 'site' not in imported
+    output = subprocess.check_output(launch, env=dict(env, AACTIVATOR_VERSION='0'), cwd=str(venv_path), input=b'y\n')
+    assert output.decode().startswith(aactivator.init(exe) + ' &&\n' + activates(venv_path))
+
+
+def _median_startup(argv, env, runs=11):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, env=env, stdout=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[runs // 2]
+
+
+def test_launch_command_starts_faster_than_console_script(tmpdir, inactive_env):
+    wrapper = os.path.join(os.path.dirname(sys.executable), 'aactivator')
+    if not os.path.exists(wrapper):
+        pytest.skip('aactivator is not installed as a console script')
+    env = dict(inactive_env)
+    launch = shlex.split(aactivator.launch_command(str(tmpdir.join('exe')))) + ['init']
+    # Make sure both start from a byte-compiled module
+    subprocess.run(launch, env=env, stdout=subprocess.DEVNULL, check=True)
+
+    launcher = _median_startup(launch, env)
+    console_script = _median_startup((sys.executable, wrapper, 'init'), env)
+    assert launcher < console_script, (launcher, console_script)
+
+
+def test_init_chpwd_trigger(tmpdir):
+    exe = str(tmpdir.join('exe'))
+    assert 'chpwd_functions' not in aactivator.init(exe)
+    chpwd = aactivator.init(exe, trigger='chpwd')
+    assert 'chpwd_functions=(precmd_aactivator $chpwd_functions)' in chpwd
+    launch = aactivator.launch_command(exe)
+    assert '_aactivator_reply="`AACTIVATOR_SHELL_PID=$$ {launch} --trigger=chpwd`"'.format(launch=launch) in chpwd
+    assert '_aactivator_reply="`AACTIVATOR_SHELL_PID=$$ {launch} --mode=fast --trigger=chpwd`"'.format(launch=launch) in (
+        aactivator.init(exe, mode='fast', trigger='chpwd')
+    )
+
+
+@pytest.fixture
+def snapshot(tmpdir):
+    return tmpdir.join('.cache/aactivator/snapshot.sh')
+
+
+def test_get_output_fast_mode_writes_snapshot(tmpdir, venv_path, inactive_env, allowed_config, snapshot):
+    make_venv_in_tempdir(tmpdir)
+    allowed_config.write(str(venv_path) + '\n', ensure=True)
+    output = aactivator.get_output(dict(inactive_env), str(venv_path), memo=True, mode='fast')
+    assert output.endswith(
+        '_aactivator_snapshot={snapshot} &&\n. "$_aactivator_snapshot"'.format(snapshot=snapshot),
+    )
+    assert (
+        '_aactivator_allowed() {{ case "$1" in {venv_path}) return 0;; esac; return 1; }}\n'.format(
+            venv_path=venv_path,
+        )
+    ) in snapshot.read()
+
+
+def test_snapshot_refreshed_only_when_config_changes(tmpdir, inactive_env, allowed_config, snapshot):
+    allowed_config.write('/a\n', ensure=True)
+    aactivator.get_output(dict(inactive_env), str(tmpdir), mode='fast')
+    generated = os.stat(str(snapshot)).st_mtime_ns
+    aactivator.get_output(dict(inactive_env), str(tmpdir), mode='fast')
+    assert os.stat(str(snapshot)).st_mtime_ns == generated
+
+    allowed_config.write('/a\n/b\n')
+    os.utime(str(allowed_config), ns=(generated + 10 ** 9, generated + 10 ** 9))
+    aactivator.get_output(dict(inactive_env), str(tmpdir), mode='fast')
+    assert 'in /a|/b)' in snapshot.read()
+
+
+def test_snapshot_answers_in_the_shell(tmpdir, inactive_env, snapshot):
+    config = tmpdir.join('.cache/aactivator')
+    config.join('allowed').write('/a b\n/c*\n', ensure=True)
+    config.join('disallowed').write('/d\n')
+    config.join('not-now').write(str(tmpdir.join('e/f')) + '\n')
+    tmpdir.mkdir('e')
+    aactivator.get_output(dict(inactive_env), str(tmpdir.join('e')), mode='fast')
+
+    def answers(function, arg, pwd=str(tmpdir.join('e'))):
+        return subprocess.call(
+            ('bash', '-c', 'cd "$1" && . "$2" && {} "$3"'.format(function), '-', pwd, str(snapshot), arg),
+        ) == 0
+
+    assert answers('_aactivator_allowed', '/a b')
+    assert answers('_aactivator_allowed', '/c*')
+    assert not answers('_aactivator_allowed', '/cd')
+    assert not answers('_aactivator_allowed', '/d')
+    assert answers('_aactivator_declined', '/d')
+    assert answers('_aactivator_declined', str(tmpdir.join('e/f')))
+    assert not answers('_aactivator_declined', '/a b')
+    assert answers('_aactivator_not_now_holds', '')
+    assert not answers('_aactivator_not_now_holds', '', pwd='/')
+    assert not answers('_aactivator_snapshot_stale', '')
+
+
+def test_server_handle_passes_options(tmpdir, inactive_env, server):
+    client, conn = socket.socketpair()
+    request = [str(tmpdir), '/path/to/aactivator', '--mode=fast']
+    request += ['{}={}'.format(name, value) for name, value in inactive_env]
+    client.sendall('\0'.join(request).encode())
+    client.shutdown(socket.SHUT_WR)
+    server.handle(conn)
+    conn.close()
+    assert client.recv(65536).decode() == aactivator.get_output(
+        dict(inactive_env), str(tmpdir), memo=True, mode='fast',
+    )
+
+
+@pytest.fixture
+def hung_path(tmpdir, monkeypatch):
+    """A path whose stat and lstat hang until the end of the test"""
+    path = tmpdir.join('hung')
+    path.ensure('child', dir=True)
+    release = threading.Event()
+
+    def hanging(real):
+        def hanging_stat(name, *args, **kwargs):
+            if name == str(path):
+                release.wait()
+            return real(name, *args, **kwargs)
+        return hanging_stat
+
+    monkeypatch.setattr(os, 'stat', hanging(os.stat))
+    monkeypatch.setattr(os, 'lstat', hanging(os.lstat))
+    yield path
+    release.set()
+
+
+def test_stat_cache_with_timeout(tmpdir, hung_path):
+    stats = aactivator.StatCache(timeout=0.05)
+    assert stats.stat(str(tmpdir)) == os.lstat(str(tmpdir))
+    assert stats.stat(str(tmpdir.join('nope'))) is None
+    with pytest.raises(aactivator.SlowFilesystem) as excinfo:
+        stats.stat(str(hung_path))
+    assert excinfo.value.path == str(hung_path)
+    assert stats.timed_out == str(hung_path)
+
+
+@pytest.fixture
+def timeout_env(inactive_env):
+    return inactive_env + (('AACTIVATOR_TIMEOUT_MS', '50'),)
+
+
+def test_get_output_gives_up_on_slow_paths(tmpdir, hung_path, timeout_env):
+    child = hung_path.join('child')
+    assert aactivator.get_output(dict(timeout_env), str(child)) == (
+        "echo 'aactivator: {0} did not answer within 50ms, leaving it alone for 10s' >&2".format(hung_path)
+    )
+    slow = aactivator.SlowPaths(str(tmpdir.join('.cache/aactivator')))
+    assert slow.entries == {str(hung_path): (mock.ANY, 1)}
+
+    # from then on, it's skipped without a look
+    assert aactivator.get_output(dict(timeout_env), str(child)) == ''
+    assert aactivator.get_output(dict(timeout_env), str(tmpdir)) == ''
+
+
+def test_get_output_pwd_goes_missing_with_timeout(tmpdir, venv_path, timeout_env):
+    make_venv_in_tempdir(tmpdir)
+    with venv_path.as_cwd():
+        venv_path.remove(rec=1)
+        assert aactivator.get_output(dict(timeout_env), '.', lambda: 'n') == ''
+
+
+def test_get_output_timeout_excludes_the_prompt(tmpdir, venv_path, timeout_env):
+    make_venv_in_tempdir(tmpdir)
+
+    def slow_yes():
+        time.sleep(0.2)
+        return 'y'
+
+    output = aactivator.get_output(dict(timeout_env), str(venv_path), slow_yes)
+    assert activates(venv_path) in output
+    assert not tmpdir.join('.cache/aactivator/slow').check()
+
+
+def test_get_output_never_holds_the_root(tmpdir, timeout_env):
+    class SlowRoot(aactivator.ActivateConfig):
+        def find_allowed(self, path):
+            raise aactivator.SlowFilesystem('/')
+
+    assert aactivator.get_output(dict(timeout_env), str(tmpdir), _config=SlowRoot) == (
+        "echo 'aactivator: gave up after 50ms' >&2"
+    )
+    assert aactivator.SlowPaths(str(tmpdir.join('.cache/aactivator'))).entries == {}
+
+
+def test_slow_paths_back_off_and_recover(tmpdir):
+    slow = aactivator.SlowPaths(str(tmpdir))
+    assert slow.failed('/slow', 1000) == 10
+    assert slow.held(['/slow/a'], 1009)
+    assert not slow.held(['/slow/a'], 1010)
+    assert not slow.held(['/other'], 1000)
+    assert slow.failed('/slow', 1010) == 20
+    assert aactivator.SlowPaths(str(tmpdir)).entries == {'/slow': (1030, 2)}
+
+    slow.recovered(['/other'])
+    assert slow.entries
+    slow.recovered(['/slow/a'])
+    assert aactivator.SlowPaths(str(tmpdir)).entries == {}
+
+
+def test_get_output_forgets_recovered_paths(tmpdir, timeout_env):
+    slow = aactivator.SlowPaths(str(tmpdir.join('.cache/aactivator')))
+    slow.failed(str(tmpdir), 0)
+    assert aactivator.get_output(dict(timeout_env), str(tmpdir)) == ''
+    assert aactivator.SlowPaths(str(tmpdir.join('.cache/aactivator'))).entries == {}
+
+
+def test_parse_mountinfo():
+    assert aactivator.parse_mountinfo(
+        b'23 28 0:22 / /proc rw,relatime - proc proc rw\n'
+        b'28 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw\n'
+        b'40 28 0:50 / /home/me/my\\040files rw master:2 - fuse.sshfs me@host: rw\n'
+        b'41 28 0:51 / /proc rw - tmpfs tmpfs rw\n'
+        b'garbage\n'
+    ) == {
+        '/': (os.makedev(8, 1), 'ext4'),
+        '/proc': (os.makedev(0, 51), 'tmpfs'),
+        '/home/me/my files': (os.makedev(0, 50), 'fuse.sshfs'),
+    }
+
+
+def test_read_mounts(tmpdir):
+    assert aactivator.read_mounts(str(tmpdir.join('nope'))) is None
+    mountinfo = tmpdir.join('mountinfo')
+    mountinfo.write('28 1 8:1 / / rw - ext4 /dev/sda1 rw\n')
+    assert aactivator.read_mounts(str(mountinfo)) == {'/': (os.makedev(8, 1), 'ext4')}
+    assert aactivator.read_mounts(str(mountinfo)) is aactivator.read_mounts(str(mountinfo))
+
+
+@pytest.fixture
+def mounted_tree(tmpdir, monkeypatch):
+    """tmpdir/a/b, with tmpdir standing in for a mount point"""
+    tree = tmpdir.join('a/b')
+    tree.ensure(dir=True)
+    mounts = {}
+    monkeypatch.setattr(aactivator, 'read_mounts', lambda: mounts)
+    return tree, mounts
+
+
+def test_search_parent_paths_stops_at_mount_point(tmpdir, mounted_tree):
+    tree, mounts = mounted_tree
+    dev = tmpdir.stat().dev
+    mounts.update({'/': (dev + 1, 'ext4'), str(tmpdir): (dev, 'tmpfs')})
+    stats = aactivator.StatCache()
+    assert list(aactivator.search_parent_paths(str(tree), stats)) == [str(tree), tree.dirname, str(tmpdir)]
+    assert stats.calls == 1
+
+
+def test_search_parent_paths_goes_through_bind_mounts(tmpdir, mounted_tree):
+    tree, mounts = mounted_tree
+    dev = tmpdir.stat().dev
+    mounts.update({'/': (dev, 'ext4'), str(tmpdir): (dev, 'ext4')})
+    paths = list(aactivator.search_parent_paths(str(tree)))
+    assert paths[:3] == [str(tree), tree.dirname, str(tmpdir)]
+    assert paths[-1] == '/'
+
+
+def test_search_parent_paths_skips_fstypes(tmpdir, mounted_tree):
+    tree, mounts = mounted_tree
+    mounts.update({'/': (tmpdir.stat().dev, 'fuse.sshfs')})
+    assert list(aactivator.search_parent_paths(str(tree), skip_fstypes={'fuse'})) == []
+    assert list(aactivator.search_parent_paths(str(tree), skip_fstypes={'nfs'}))
+
+
+def test_search_parent_paths_falls_back_to_stat(tmpdir, mounted_tree, monkeypatch):
+    tree, mounts = mounted_tree
+    # The mount table doesn't agree with stat, as with btrfs subvolumes
+    mounts.update({'/': (tmpdir.stat().dev + 1, 'btrfs')})
+    paths = list(aactivator.search_parent_paths(str(tree)))
+    monkeypatch.setattr(aactivator, 'read_mounts', lambda: None)
+    assert paths == list(aactivator.search_parent_paths(str(tree)))
+
+
+def test_profile(tmpdir, venv_path, inactive_env, allowed_config):
+    make_venv_in_tempdir(tmpdir)
+    allowed_config.write(str(venv_path) + '\n', ensure=True)
+    log = tmpdir.join('profile.jsonl')
+    env = dict(inactive_env, AACTIVATOR_PROFILE=str(log))
+    aactivator.get_output(env, str(venv_path))
+    aactivator.get_output(dict(env, AACTIVATOR_ACTIVE=str(venv_path)), str(venv_path))
+
+    first, second = [json.loads(line) for line in log.readlines()]
+    assert list(first['phases']) == ['realpath', 'config', 'not_now', 'walk', 'render']
+    assert first['pwd'] == first['found'] == str(venv_path)
+    assert (first['outcome'], second['outcome']) == ('activate', 'none')
+    assert first['config_bytes'] == {'allowed': len(str(venv_path)) + 1, 'not-now': 0, 'disallowed': 0}
+    assert 'startup_ms' not in first
+    for name in ('ms', 'stats', 'reads', 'bytes'):
+        assert sum(phase[name] for phase in first['phases'].values()) <= first['total'][name] + 0.01
+    assert first['total']['stats'] > 0
+    assert first['phases']['config']['reads'] == 1
+    assert first['phases']['config']['bytes'] == first['config_bytes']['allowed']
+
+
+def test_profile_from_the_hook(tmpdir, inactive_env):
+    log = tmpdir.join('profile.jsonl')
+    aactivator.aactivator(('aactivator',), dict(inactive_env, AACTIVATOR_PROFILE=str(log)))
+    record = json.loads(log.read())
+    assert record['startup_ms'] > 0
+    assert record['outcome'] == 'none'
+
+
+def test_no_profile_by_default(inactive_env):
+    assert aactivator.open_profile(dict(inactive_env)) is aactivator.NULL_PROFILE
+
+
+def test_histogram_percentiles():
+    histogram = aactivator.Histogram()
+    for ms in range(1, 1001):
+        histogram.add(ms)
+    assert histogram.count == 1000
+    for percent in (50, 90, 99):
+        assert percent * 10 <= histogram.percentile(percent) <= percent * 10 * 1.05
+    assert histogram.percentile(100) == 1000
+    assert aactivator.Histogram().percentile(50) == 0
+
+
+def test_slowest_keeps_the_largest():
+    slowest = aactivator.Slowest(size=2)
+    for key, value in (('a', 1), ('b', 5), ('c', 3), ('a', 4), ('d', 2), ('c', 6)):
+        slowest.add(key, value)
+    assert slowest.items() == [('c', 6), ('b', 5)]
+
+
+def test_profile_times_activate_sh(tmpdir, venv_path, inactive_env, allowed_config):
+    make_venv_in_tempdir(tmpdir)
+    allowed_config.write(str(venv_path) + '\n', ensure=True)
+    log = tmpdir.join('profile.jsonl')
+    output = aactivator.get_output(dict(inactive_env, AACTIVATOR_PROFILE=str(log)), str(venv_path))
+    assert output.startswith(
+        '{{ _aactivator_enter {0} && _aactivator_start="${{EPOCHREALTIME/[.,]/}}" &&\nsource ./.activate.sh &&\n{{ '
+        .format(venv_path)
+    )
+    subprocess.check_call((
+        'bash', '-c', aactivator.init(sys.executable) + '\nalias() { :; } && ' + output,
+    ))
+    script = json.loads(log.readlines()[-1])
+    assert script['script'] == str(venv_path.join('.activate.sh'))
+    assert script['us'] >= 0
+
+
+def test_stats_subcommand(tmpdir, venv_path, inactive_env, allowed_config):
+    make_venv_in_tempdir(tmpdir)
+    allowed_config.write(str(venv_path) + '\n', ensure=True)
+    log = tmpdir.join('profile.jsonl')
+    env = dict(inactive_env, AACTIVATOR_PROFILE=str(log))
+    aactivator.get_output(env, str(venv_path))
+    aactivator.get_output(env, str(tmpdir))
+    log.write('{"script": "/a/.activate.sh", "us": 1500}\nnot json\n', mode='a')
+
+    report = aactivator.aactivator(('aactivator', 'stats'), env)
+    assert report == aactivator.aactivator(('aactivator', 'stats', str(log)), {})
+    lines = report.splitlines()
+    assert lines[:2] == ['2 prompts', '1 lines could not be read']
+    for heading in ('phase', 'outcome', 'project'):
+        assert any(line.startswith(heading + ' ') and line.endswith('p99 ms') for line in lines)
+    assert any(line.startswith('activate ') for line in lines)
+    assert any(line.startswith(str(venv_path) + ' ') for line in lines)
+    assert lines[-2:] == ['slowest .activate.sh (ms)', '      1.50  /a/.activate.sh']
+
+
+def test_stats_subcommand_needs_a_profile(tmpdir):
+    with pytest.raises(SystemExit) as excinfo:
+        aactivator.aactivator(('aactivator', 'stats'), {})
+    assert 'set AACTIVATOR_PROFILE' in str(excinfo.value)
+    with pytest.raises(SystemExit) as excinfo:
+        aactivator.aactivator(('aactivator', 'stats', str(tmpdir.join('nope'))), {})
+    assert 'Cannot read profile' in str(excinfo.value)
+
+
+@pytest.fixture
+def messy_config(tmpdir, venv_path, allowed_config, disallowed_config):
+    make_venv_in_tempdir(tmpdir)
+    venv2 = make_venv_in_tempdir(tmpdir, 'venv2')
+    gone = str(tmpdir.join('gone'))
+    allowed_config.write('\n'.join((str(venv2), gone, str(venv_path), str(venv2))) + '\n', ensure=True)
+    disallowed_config.write(str(tmpdir.join('also-gone')) + '\n')
+    return [str(venv_path), str(venv2)]
+
+
+def test_gc(tmpdir, inactive_env, allowed_config, disallowed_config, messy_config):
+    assert aactivator.aactivator(('aactivator', 'gc'), dict(inactive_env)) == (
+        'allowed: 4 -> 2 entries\n'
+        'disallowed: 1 -> 0 entries'
+    )
+    assert allowed_config.read().splitlines() == messy_config
+    assert disallowed_config.read() == ''
+
+
+def test_gc_keeps_dangling_activate_sh_symlinks(tmpdir, venv_path, activate, inactive_env, allowed_config):
+    make_venv_in_tempdir(tmpdir)
+    activate.remove()
+    activate.mksymlinkto(venv_path.join('bin/activate'))
+    allowed_config.write(str(venv_path) + '\n', ensure=True)
+    assert aactivator.aactivator(('aactivator', 'gc'), dict(inactive_env)) == 'allowed: 1 -> 1 entries'
+    assert allowed_config.read() == str(venv_path) + '\n'
+
+
+def test_gc_prunes_stamps_of_exited_shells(tmpdir, inactive_env):
+    exited = subprocess.Popen(('true',))
+    exited.wait()
+    stamps = tmpdir.join('.cache/aactivator/stamps')
+    stamps.join(str(os.getpid())).ensure()
+    stamps.join(str(exited.pid)).ensure()
+    stamps.join('junk').ensure()
+    assert aactivator.aactivator(('aactivator', 'gc'), dict(inactive_env)) == 'stamps: 3 -> 1 entries'
+    assert stamps.listdir() == [stamps.join(str(os.getpid()))]
+
+
+def test_hook_prunes_stamps_when_large(tmpdir, inactive_env, monkeypatch):
+    exited = subprocess.Popen(('true',))
+    exited.wait()
+    stale = tmpdir.join('.cache/aactivator/stamps', str(exited.pid)).ensure()
+    monkeypatch.setattr(aactivator, 'STAMPS_GC_SIZE', 0)
+    # Only for the hook, which makes them
+    aactivator.get_output(dict(inactive_env), str(tmpdir))
+    assert stale.check()
+
+    aactivator.get_output(dict(inactive_env), str(tmpdir), memo=True)
+    assert not stale.check()
+    size = stale.dirpath().size()
+    assert tmpdir.join('.cache/aactivator/gc').read() == 'stamps {0}\n'.format(size)
+
+    # Not again until the directory doubles in size
+    stale.ensure()
+    aactivator.get_output(dict(inactive_env), str(tmpdir), memo=True)
+    assert stale.check()
+
+
+def test_gc_prunes_only_this_hosts_restore_points(tmpdir, inactive_env):
+    exited = subprocess.Popen(('true',))
+    exited.wait()
+    restore = tmpdir.join('.cache/aactivator/restore')
+    here = restore.join(os.uname().nodename, '{0}-0123456789abcdef.before'.format(exited.pid)).ensure()
+    there = restore.join('elsewhere', here.basename).ensure()
+    assert aactivator.aactivator(('aactivator', 'gc'), dict(inactive_env)) == 'restore: 1 -> 0 entries'
+    assert not here.check()
+    assert there.check()
+
+
+def test_gc_when_large(tmpdir, inactive_env, allowed_config, messy_config):
+    env = dict(inactive_env, AACTIVATOR_GC_SIZE='10')
+    aactivator.get_output(env, str(tmpdir))
+    assert allowed_config.read().splitlines() == messy_config
+    size = allowed_config.size()
+    assert tmpdir.join('.cache/aactivator/gc').read() == (
+        'allowed {0}\ndisallowed 0\nnot-now 0\n'.format(size)
+    )
+
+    # Not again until the file doubles in size
+    allowed_config.write(messy_config[0] + '\n', mode='a')
+    aactivator.get_output(env, str(tmpdir))
+    assert allowed_config.read().splitlines() == messy_config + messy_config[:1]
+    allowed_config.write('\n'.join(messy_config) + '\n', mode='a')
+    aactivator.get_output(env, str(tmpdir))
+    assert allowed_config.read().splitlines() == messy_config
+
+
+def test_no_gc_by_default(tmpdir, inactive_env, allowed_config, messy_config):
+    before = allowed_config.read()
+    aactivator.get_output(dict(inactive_env), str(tmpdir))
+    assert allowed_config.read() == before
+
+
+def test_env_snapshot_key(tmpdir, venv_path, activate):
+    make_venv_in_tempdir(tmpdir)
+    snapshots = aactivator.EnvSnapshots(str(tmpdir), 'aactivator')
+    key = snapshots.key(str(venv_path))
+    assert key == snapshots.key(str(venv_path))
+    activate.write('# aactivator-depends: requirements.txt\n', mode='a')
+    depends = snapshots.key(str(venv_path))
+    assert depends != key
+    venv_path.join('requirements.txt').write('six\n')
+    assert snapshots.key(str(venv_path)) != depends
+
+
+def test_env_snapshot_record_and_replay(tmpdir):
+    snapshots = aactivator.EnvSnapshots(str(tmpdir), 'aactivator')
+    before = {'PATH': '/bin', 'GONE': '1', 'SAME': 'x', 'PWD': '/', 'LIST': 'a'}
+    after = {'PATH': '/venv/bin:/bin', 'SAME': 'x', 'NEW': "it's", 'PWD': '/venv', 'LIST': 'a:b'}
+    snapshots.record('before', 'key', before, "alias ll='ls -l'\n")
+    assert snapshots.replay('key') is None
+    snapshots.record('after', 'key', after, "alias ll='ls -l'\nalias t='pytest'\n")
+    assert not tmpdir.join('env/key.before.json').check()
+    assert tmpdir.join('env').stat().mode & 0o777 == 0o700
+    assert snapshots.replay('key') == (
+        'unset GONE &&\n'
+        'export LIST="$LIST":b &&\n'
+        'export NEW=\'it\'"\'"\'s\' &&\n'
+        'export PATH=/venv/bin:"$PATH" &&\n'
+        "alias t='pytest'"
+    )
+
+    tmpdir.join('env/key.json').chmod(0o666)
+    assert snapshots.replay('key') is None
+
+
+def test_get_output_env_cache(tmpdir, venv_path, inactive_env, allowed_config):
+    make_venv_in_tempdir(tmpdir)
+    allowed_config.write(str(venv_path) + '\n', ensure=True)
+    env = dict(inactive_env, AACTIVATOR_ENV_CACHE='1')
+    key = aactivator.EnvSnapshots(str(tmpdir), 'aactivator').key(str(venv_path))
+    record = (
+        '{{ {{ if [ "$ZSH_VERSION" ]; then alias -L; else alias; fi; }} | '
+        'aactivator env-record {0} ' + key + ' >/dev/null || :; }} &&\n'
+    )
+    assert aactivator.get_output(env, str(venv_path), arg0='aactivator') == activates(
+        venv_path,
+        record.format('before') + 'source ./.activate.sh &&\n' + record.format('after')[:-len(' &&\n')],
+    )
+
+    for stage in ('before', 'after'):
+        with mock.patch.object(sys, 'stdin', io.StringIO('')):
+            assert aactivator.aactivator(
+                ('aactivator', 'env-record', stage, key),
+                dict(env, PWD='/', NEW='1' if stage == 'after' else ''),
+            ) == ''
+    assert aactivator.get_output(env, str(venv_path), arg0='aactivator') == activates(venv_path, 'export NEW=1')
+
+
+def test_parse_exports():
+    values = {'PLAIN': 'a', 'QUOTES': 'it\'s "x"', 'SPECIAL': '$HOME `x` \\ !', 'LINES': 'a\nb', 'EMPTY': '', 'U': 'é'}
+    printed = subprocess.check_output(('bash', '-c', 'export -p'), env=values).decode()
+    exports = aactivator.parse_exports(printed)
+    assert {name: exports[name] for name in values} == values
+    assert aactivator.parse_exports(printed.replace('declare -x', 'export')) == exports
+
+    # As zsh prints them
+    assert aactivator.parse_exports(
+        "export A='it'\\''s'\n"
+        "export B=$'a\\nb\\x41\\101\\'c'\n"
+        "typeset -x C=plain\\ word\n"
+        "export -T PATH path=( /bin '/my dir' )\n"
+        "export D\n"
+    ) == {'A': "it's", 'B': "a\nbAA'c", 'C': 'plain word', 'PATH': '/bin:/my dir'}
+
+
+def test_restore_points(tmpdir):
+    restore = aactivator.RestorePoints(str(tmpdir), '12')
+    script = restore.capture('/a/b', 'export NEW=1 PATH=/venv:"$PATH" && unset GONE') + ' && echo "$AACTIVATOR_PENDING"'
+    env = {'PATH': '/bin:/usr/bin', 'GONE': "it's", 'AACTIVATOR_PENDING': '1-elsewhere'}
+    pending = subprocess.check_output(('bash', '-c', script), env=env).decode().strip()
+    assert pending == '1-elsewhere 12-' + restore.key('/a/b')
+    directory = tmpdir.join('restore', os.uname().nodename)
+    assert directory.stat().mode & 0o777 == 0o700
+    files = directory.listdir()
+    assert len(files) == 2
+    assert all(path.stat().mode & 0o777 == 0o600 for path in files)
+
+    # Left alone when inherited from another shell
+    noted = aactivator.RestorePoints(str(tmpdir), '13').settle(pending, ['/a', '/a/b'])
+    assert noted == {'/a/b': [['GONE', "it's"], ['NEW', None], ['PATH', '/bin:/usr/bin']]}
+    assert directory.listdir() == files
+    assert restore.settle(pending, ['/a', '/a/b']) == noted
+    assert directory.listdir() == []
+    output = aactivator.restore_variable_command(noted)
+    noted = aactivator.noted_changes({'AACTIVATOR_RESTORE': shlex.split(output)[1].partition('=')[2]})
+    assert aactivator.restore_commands(noted['/a/b']) == [
+        "export GONE='it'\"'\"'s'",
+        'unset NEW',
+        'export PATH=/bin:/usr/bin',
+    ]
+    assert aactivator.noted_changes({'AACTIVATOR_RESTORE': 'oops'}) == {}
+    assert aactivator.restore_variable_command({}) == 'unset AACTIVATOR_RESTORE'
+
+
+def test_get_output_records_changes_without_deactivate(tmpdir, venv_path, deactivate, inactive_env, allowed_config):
+    make_venv_in_tempdir(tmpdir)
+    deactivate.remove()
+    allowed_config.write(str(venv_path) + '\n', ensure=True)
+    output = aactivator.get_output(dict(inactive_env), str(venv_path))
+    restore = aactivator.RestorePoints(str(tmpdir.join('.cache/aactivator')))
+    assert output == activates(venv_path, restore.capture(str(venv_path), 'source ./.activate.sh'))
+    # Without any more processes
+    assert '$(' not in output and '`' not in output
+
+
+def test_get_output_settles_pending_changes(tmpdir, venv_path, deactivate, active_env, allowed_config):
+    make_venv_in_tempdir(tmpdir)
+    allowed_config.write(str(venv_path) + '\n', ensure=True)
+    deactivate.remove()
+    restore = tmpdir.join('.cache/aactivator/restore', os.uname().nodename)
+    entry = '1-' + aactivator.RestorePoints.key(str(venv_path))
+    restore.join(entry + '.before').write('declare -x PATH="/bin"\n', ensure=True)
+    restore.join(entry + '.after').write('declare -x NEW="1"\ndeclare -x PATH="/venv:/bin"\n')
+    env = dict(active_env, AACTIVATOR_PENDING=entry, AACTIVATOR_SHELL_PID='2')
+    assert aactivator.get_output(env, str(venv_path)) == (
+        'export AACTIVATOR_RESTORE=\'{{"{0}":[["NEW",null],["PATH","/bin"]]}}\' &&\n'
+        'unset AACTIVATOR_PENDING'.format(venv_path)
+    )
+    env['AACTIVATOR_SHELL_PID'] = '1'
+    assert aactivator.get_output(env, str(tmpdir)) == (
+        'unset AACTIVATOR_RESTORE &&\n'
+        'unset AACTIVATOR_PENDING &&\n'
+        'unset NEW\n'
+        'export PATH=/bin\n'
+        'unset AACTIVATOR_ACTIVE'
+    )
+    # Only the changes are kept
+    assert restore.listdir() == []
+
+
+def test_get_output_restores_without_deactivate(tmpdir, venv_path, deactivate, active_env):
+    make_venv_in_tempdir(tmpdir)
+    deactivate.remove()
+    noted = {str(venv_path): [['NEW', None], ['PATH', '/bin']], '/other': [['OTHER', None]]}
+    env = dict(active_env, AACTIVATOR_RESTORE=json.dumps(noted))
+    assert aactivator.get_output(env, str(tmpdir)) == (
+        'export AACTIVATOR_RESTORE=\'{"/other":[["OTHER",null]]}\' &&\n'
+        'unset NEW\n'
+        'export PATH=/bin\n'
+        'unset AACTIVATOR_ACTIVE'
+    )
+
+
+def test_find_projects(tmpdir, mounted_tree):
+    _, mounts = mounted_tree
+    dev = tmpdir.stat().dev
+    mounts.update({'/': (dev, 'ext4'), str(tmpdir.join('mnt')): (dev, 'ext4')})
+    for project in ('p1', 'deep/x/y/p2', 'mnt/p3'):
+        tmpdir.join(project, '.activate.sh').ensure()
+    tmpdir.join('link').mksymlinkto(tmpdir.join('p1'))
+    assert aactivator.find_projects(str(tmpdir), workers=4) == [
+        str(tmpdir.join('deep/x/y/p2')), str(tmpdir.join('p1')),
+    ]
+    assert aactivator.find_projects(str(tmpdir), skip_fstypes=('ext4',)) == []
+
+
+def test_allow_recursive(tmpdir, capsys, inactive_env, allowed_config, disallowed_config):
+    for project in ('new', 'insecure', 'allowed', 'disallowed', 'not-now'):
+        tmpdir.join('projects', project, '.activate.sh').ensure()
+    projects = tmpdir.join('projects')
+    projects.join('insecure/.activate.sh').chmod(0o666)
+    allowed_config.write(str(projects.join('allowed')) + '\n', ensure=True)
+    disallowed_config.write(str(projects.join('disallowed')) + '\n')
+    not_now = tmpdir.join('.cache/aactivator/not-now')
+    not_now.write(str(projects.join('not-now')) + '\n')
+
+    env = dict(inactive_env)
+    assert aactivator.allow_recursive(env, str(projects), lambda: 'n') == ''
+    assert allowed_config.read().splitlines() == [str(projects.join('allowed'))]
+    with mock.patch.object(sys, 'stdin', io.StringIO('n\n')):
+        assert aactivator.aactivator(('aactivator', 'allow', '--recursive', str(projects)), env) == ''
+    assert aactivator.allow_recursive(env, str(projects), lambda: 'y') == (
+        'aactivator will remember this: ~/.cache/aactivator/allowed'
+    )
+    assert allowed_config.read().splitlines() == sorted(
+        str(projects.join(project)) for project in ('allowed', 'new', 'not-now')
+    )
+    assert not_now.read() == ''
+    assert capsys.readouterr().err.endswith(
+        'aactivator: Cowardly refusing to source insecure/.activate.sh because writeable by others: '
+        'insecure/.activate.sh\n'
+        'aactivator will source .activate.sh and .deactivate.sh at:\n'
+        '    {0}\n'
+        '    {1}\n'
+        'and skip the others (1 already allowed, 1 disallowed).\n'
+        'Acceptable? (y)es (n)o: '.format(projects.join('new'), projects.join('not-now'))
+    )
+
+    assert aactivator.allow_recursive(env, str(projects), lambda: 'y', _getuid=lambda: -1) == (
+        'aactivator: Nothing to allow under {0} (5 owned by someone else)'.format(projects)
+    )
+
+
+@pytest.fixture
+def nested_projects(tmpdir, venv_path, inactive_env, allowed_config):
+    make_venv_in_tempdir(tmpdir)
+    inner = make_venv_in_tempdir(venv_path, 'inner')
+    sibling = make_venv_in_tempdir(venv_path, 'sibling')
+    allowed_config.write(''.join(str(path) + '\n' for path in (venv_path, inner, sibling)), ensure=True)
+    return dict(inactive_env, AACTIVATOR_NESTED='1'), str(venv_path), str(inner), str(sibling)
+
+
+def stacked(env, *stack):
+    return dict(env, AACTIVATOR_ACTIVE=stack[-1], AACTIVATOR_STACK=json.dumps(stack))
+
+
+def test_get_output_nested_enters_every_level(nested_projects):
+    env, outer, inner, _ = nested_projects
+    assert aactivator.get_output(env, inner) == ' &&\n'.join((
+        aactivator.aactivate(outer),
+        aactivator.aactivate(inner),
+        'export AACTIVATOR_STACK={0} AACTIVATOR_ACTIVE={1}'.format(
+            aactivator.quote(json.dumps([outer, inner], separators=(',', ':'))), inner,
+        ),
+    ))
+    assert aactivator.get_output(stacked(env, outer, inner), inner) == ''
+
+
+def test_get_output_nested_keeps_the_shared_level(nested_projects):
+    env, outer, inner, sibling = nested_projects
+    assert aactivator.get_output(stacked(env, outer, inner), sibling) == ' &&\n'.join((
+        deactivates(inner),
+        activates(sibling),
+        'export AACTIVATOR_STACK={0} AACTIVATOR_ACTIVE={1}'.format(
+            aactivator.quote(json.dumps([outer, sibling], separators=(',', ':'))), sibling,
+        ),
+    ))
+    assert aactivator.get_output(stacked(env, outer, inner), outer) == ' &&\n'.join((
+        aactivator.deaactivate(inner),
+        'export AACTIVATOR_STACK={0} AACTIVATOR_ACTIVE={1}'.format(
+            aactivator.quote(json.dumps([outer], separators=(',', ':'))), outer,
+        ),
+    ))
+    assert aactivator.get_output(stacked(env, outer, inner), '/') == ' &&\n'.join((
+        aactivator.deaactivate(inner),
+        aactivator.deaactivate(outer),
+        'unset AACTIVATOR_STACK',
+    ))
+
+
+def test_get_output_nested_watches_every_parent(tmpdir, nested_projects):
+    env, outer, inner, _ = nested_projects
+    output = aactivator.get_output(stacked(env, outer, inner), inner, memo=True)
+    watched = shlex.split(output.partition('_aactivator_watch=(')[2].partition(')')[0])
+    assert {inner, outer, str(tmpdir)} <= set(watched)
+
+
+def test_fast_mode_leaves_nesting_to_python(tmpdir, venv_path, inactive_env, allowed_config):
+    make_venv_in_tempdir(tmpdir)
+    allowed_config.write(str(venv_path) + '\n', ensure=True)
+    env = dict(inactive_env, PATH=os.defpath)
+    output = aactivator.get_output(env, str(venv_path), memo=True, mode='fast')
+    script = '\n'.join((
+        aactivator.init(sys.executable, mode='fast'),
+        'alias() { :; }',
+        output,
+        '_aactivator_fast && echo innermost',
+        'AACTIVATOR_NESTED=1',
+        '_aactivator_fast || echo nested',
+    ))
+    assert subprocess.check_output(('bash', '-c', script), cwd=str(venv_path), env=env).decode() == (
+        'aactivating...\ninnermost\nnested\n'
+    )
+
+
+def test_get_output_unnests(nested_projects):
+    env, outer, inner, _ = nested_projects
+    del env['AACTIVATOR_NESTED']
+    assert aactivator.get_output(stacked(env, outer, inner), inner) == ' &&\n'.join((
+        aactivator.deaactivate(inner),
+        aactivator.deaactivate(outer),
+        aactivator.aactivate(inner),
+        'unset AACTIVATOR_STACK',
+        'export AACTIVATOR_ACTIVE=' + inner,
+    ))
+    # A stack somebody deactivated by hand since is no stack
+    env = dict(env, AACTIVATOR_ACTIVE=inner, AACTIVATOR_STACK=json.dumps([outer]))
+    assert aactivator.active_stack(env) == [inner]